@@ -30,6 +30,8 @@ create table blogs (
 	`summary` varchar(200) not null,
 	`content` mediumtext not null,
 	`created_at` real not null,
+	`comment_count` bigint not null,
+	`last_commented_at` real not null,
 	key `idx_created_at` (`created_at`),
 	primary key (`id`)
 ) engine=innodb default charset=utf8;
@@ -43,9 +45,18 @@ create table comments (
 	`content` mediumtext not null,
 	`created_at` real not null,
 	key `idx_created_at` (`created_at`),
+	key `idx_blog_id_created_at` (`blog_id`, `created_at`),
 	primary key (`id`)
 ) engine=innodb default charset=utf8;
 
+create table blog_views (
+	`blog_id` varchar(50) not null,
+	`views` bigint not null,
+	`score` real not null,
+	`updated_at` real not null,
+	primary key (`blog_id`)
+) engine=innodb default charset=utf8;
+
 -- email / password:
 -- admin@example.com / password
 
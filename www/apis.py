@@ -12,6 +12,7 @@ change data to JSON form.
 import re, json, logging, functools
 
 from transwarp.web import ctx
+from transwarp.orm import Model
 
 
 class Page(object):
@@ -19,7 +20,9 @@ class Page(object):
 	Page object for display pages. 存储分页信息
 	'''
 
-	def __init__(self, item_count, page_index=1, page_size=15):
+	PAGE_SIZE = 15
+
+	def __init__(self, item_count, page_index=1, page_size=PAGE_SIZE):
 		'''
 		Init Pagination by item_count, page_index and page_size.
 
@@ -77,8 +80,67 @@ def _dump(obj):
 	raise TypeError('%s is not JSON serializable' % obj)
 
 
+# model class => (visible field names, masked field names):
+_model_fields = {}
+
+# model class => visible field names, only for models without masked fields:
+_plain_models = {}
+
+_EMPTY = frozenset()
+
+def _get_model_fields(cls):
+	r = _model_fields.get(cls)
+	if r is None:
+		masked = frozenset(getattr(cls, '__masked__', ()))
+		fields = frozenset(cls.__mappings__.iterkeys()) - masked
+		r = _model_fields[cls] = (fields, masked)
+		if not masked:
+			_plain_models[cls] = fields
+	return r
+
+
+def _prepare(obj):
+	'''
+	Exclude masked fields of Model, and convert Page to dict. A Model which only
+	contains visible fields is returned as it is.
+
+	>>> class M(Model):
+	... 	id = IntegerField(primary_key=True)
+	... 	secret = StringField()
+	... 	__masked__ = ('secret',)
+	>>> _prepare([M(id=1, secret='x')])
+	[{'id': 1}]
+	>>> _prepare(dict(m=M(id=1, secret='x', other=M(id=2, secret='y')), page=Page(1)))['m']
+	{'other': {'id': 2}, 'id': 1}
+	'''
+	if isinstance(obj, list):
+		# fast path for list of models, which is what most APIs return:
+		get = _plain_models.get
+		return [x if x.viewkeys() <= get(type(x), _EMPTY) else _prepare(x) for x in obj] if obj and isinstance(obj[0], Model) else [_prepare(x) for x in obj]
+	if isinstance(obj, Model):
+		fields, masked = _get_model_fields(type(obj))
+		if obj.viewkeys() <= fields:
+			return obj
+		return {k: v if k in fields else _prepare(v) for k, v in obj.iteritems() if not k in masked}
+	if isinstance(obj, Page):
+		return _dump(obj)
+	if isinstance(obj, dict):
+		return {k: _prepare(v) for k, v in obj.iteritems()}
+	if isinstance(obj, tuple):
+		return [_prepare(x) for x in obj]
+	return obj
+
+
 def dumps(obj):
-	return json.dumps(obj, default=_dump)
+	'''
+	Encode obj as JSON str.
+
+	>>> dumps(dict(items=[1, 2]))
+	'{"items": [1, 2]}'
+	>>> json.loads(dumps(Page(1)))['page_count']
+	1
+	'''
+	return json.dumps(_prepare(obj), default=_dump)
 
 
 class APIError(StandardError):
@@ -140,4 +202,5 @@ def api(func):
 
 if __name__ == '__main__':
 	import doctest
+	from transwarp.orm import IntegerField, StringField
 	doctest.testmod()
\ No newline at end of file
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Overhead of masking fields in apis.dumps() against plain json.dumps(obj,
+default=_dump) on /api/comments payloads, no database needed:
+
+	python bench_json.py [rounds]
+'''
+
+import sys, json, time, timeit
+
+from models import Comment
+from apis import Page, dumps, _dump
+
+
+def _old_dumps(obj):
+	return json.dumps(obj, default=_dump)
+
+
+def _payload(n):
+	comments = [Comment(id='%050d' % i, blog_id='0' * 50, user_id='1' * 50, user_name=u'Michael', user_image='http://www.gravatar.com/avatar/%032d?d=mm&s=120' % i, content=u'这是一条评论 comment %d. ' % i * 5, created_at=time.time()) for i in range(n)]
+	return dict(comments=comments, page=Page(n * 10, 1, n))
+
+
+if __name__ == '__main__':
+	rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	for n in (15, 1000):
+		obj = _payload(n)
+		assert json.loads(_old_dumps(obj)) == json.loads(dumps(obj))
+		r = max(rounds * 15 // n, 20)
+		for name, fn in (('json.dumps', _old_dumps), ('dumps', dumps)):
+			t = min(timeit.repeat(lambda: fn(obj), number=r, repeat=9))
+			print '%4d comments %-10s %8.1f us/call %8d bytes' % (n, name, t / r * 1000000, len(fn(obj)))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Overhead of request metrics: the same requests with metrics disabled and
+enabled, on handlers doing nothing so the overhead is not hidden by real work,
+no database needed:
+
+	python bench_metrics.py [requests]
+'''
+
+import os, sys, time, timeit
+
+from transwarp import metrics, profiler
+from transwarp.web import WSGIApplication, get
+
+
+@get('/plain')
+def plain():
+	return 'hello'
+
+
+@get('/blog/:blog_id')
+def blog(blog_id):
+	return ['<html>', blog_id, '</html>']
+
+
+@get('/stream')
+def stream():
+	return (s for s in ('<html>', 'x' * 100, '</html>'))
+
+
+def _start_response(status, headers):
+	pass
+
+
+def _request(app, path):
+	env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': ''}
+	def _call():
+		r = app(env, _start_response)
+		for s in r:
+			pass
+		if hasattr(r, 'close'):
+			r.close()
+	return _call
+
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+	wsgi.add_module(sys.modules[__name__])
+	app = wsgi.get_wsgi_application()
+	for path in ('/plain', '/blog/123', '/stream'):
+		fn = _request(app, path)
+		results = []
+		for enabled in (False, True):
+			metrics.enabled = enabled
+			results.append(min(timeit.repeat(fn, number=n, repeat=5)) / n * 1000000)
+		print '%-10s disabled %6.1f us/req, enabled %6.1f us/req, overhead %5.1f us/req' % (path, results[0], results[1], results[1] - results[0])
+	start = time.time()
+	s = metrics.render()
+	print 'render %d routes: %.2f ms, %d bytes' % (3, (time.time() - start) * 1000, len(s))
+	profiler.reset()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Benchmark of search.SearchIndex on a synthetic corpus, compared with a full scan
+like LIKE '%x%', no database needed:
+
+	python bench_search.py [posts]
+'''
+
+import sys, time, random, resource, tempfile, os
+
+from search import SearchIndex
+
+_WORDS = ['python', 'web', 'framework', 'database', 'mysql', 'index', 'cache', 'server', 'request', 'template', 'model', 'query', 'thread', 'process', 'network'] + ['word%d' % i for i in range(20000)]
+_CJK = u'的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严'
+
+
+def _post(rnd):
+	words = [rnd.choice(_WORDS[:15]) if rnd.random() < 0.3 else rnd.choice(_WORDS) for i in range(rnd.randint(50, 150))]
+	cjk = u''.join(rnd.choice(_CJK) for i in range(rnd.randint(50, 200)))
+	return u'%s %s' % (u' '.join(words), cjk)
+
+
+def _timeit(fn, n):
+	start = time.time()
+	for i in xrange(n):
+		fn()
+	return (time.time() - start) / n * 1000
+
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	rnd = random.Random(0)
+	docs = [('blog:%d' % i, _post(rnd)) for i in xrange(n)]
+	rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	index = SearchIndex()
+	start = time.time()
+	for key, text in docs:
+		index.add(key, text)
+	print 'build %d posts: %.1f s, +%d MB max rss' % (n, time.time() - start, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss0) // 1024)
+	fd, path = tempfile.mkstemp()
+	with os.fdopen(fd, 'wb') as f:
+		start = time.time()
+		index.dump(f)
+		print 'dump: %.1f s, %d MB' % (time.time() - start, f.tell() // 1024 // 1024)
+	with open(path, 'rb') as f:
+		start = time.time()
+		SearchIndex.load(f)
+		print 'load: %.1f s' % (time.time() - start)
+	os.remove(path)
+	for q in (u'word123', u'word123 word456', u'python', u'python database', u'数据', u'学习方法'):
+		texts = [t for k, t in docs]
+		print '%-20s index %8.2f ms/query   full scan %8.2f ms/query' % (q.encode('utf-8'), _timeit(lambda: index.search(q), 20), _timeit(lambda: [t for t in texts if q in t], 2))
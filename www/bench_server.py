@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Latency benchmark of the two local server entries of WSGIApplication.run().
+
+Each server runs in a child process and serves a handler that waits on I/O
+(time.sleep) for a while, then N client threads send requests concurrently:
+
+	python bench_server.py [concurrency] [requests] [io_ms]
+'''
+
+import os, sys, time, threading, subprocess, urllib2
+
+_PORT = 9100
+
+
+def serve(server, port, io_ms):
+	if server=='gevent':
+		from gevent import monkey; monkey.patch_all()
+	import logging; logging.basicConfig(level=logging.WARNING)
+	from transwarp.web import WSGIApplication, get
+
+	@get('/io')
+	def io():
+		time.sleep(io_ms / 1000.0)
+		return 'ok'
+
+	wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+	wsgi.add_url(io)
+	wsgi.run(port, server=server)
+
+
+def _wait_ready(url):
+	for i in range(50):
+		try:
+			urllib2.urlopen(url).read()
+			return
+		except IOError:
+			time.sleep(0.1)
+	raise RuntimeError('server not ready: %s' % url)
+
+
+def bench(server, concurrency, requests, io_ms):
+	port = _PORT + (1 if server=='gevent' else 0)
+	url = 'http://127.0.0.1:%d/io' % port
+	p = subprocess.Popen([sys.executable, __file__, 'serve', server, str(port), str(io_ms)])
+	try:
+		_wait_ready(url)
+		latencies = []
+		lock = threading.Lock()
+		def _client(n):
+			for i in range(n):
+				start = time.time()
+				urllib2.urlopen(url).read()
+				t = time.time() - start
+				with lock:
+					latencies.append(t)
+		start = time.time()
+		threads = [threading.Thread(target=_client, args=(requests // concurrency,)) for i in range(concurrency)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		total = time.time() - start
+	finally:
+		p.terminate()
+		p.wait()
+	latencies.sort()
+	pick = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+	print '%-8s requests: %d, total: %.2fs, p50: %.1fms, p99: %.1fms, req/s: %.1f' % (server, len(latencies), total, pick(0.5), pick(0.99), len(latencies) / total)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1]=='serve':
+		serve(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+	else:
+		args = [int(x) for x in sys.argv[1:]] + [20, 400, 20][len(sys.argv) - 1:]
+		for server in ('wsgiref', 'gevent'):
+			bench(server, *args)
@@ -13,9 +13,64 @@ configs = {
 		'port': 3306,
 		'user': 'www-data',
 		'password': 'www-data',
-		'database': 'awesome'
+		'database': 'awesome',
+		# read replicas for select outside transaction, e.g. [{'host': '10.0.0.2', 'port': 3306}]:
+		'replicas': [],
+		# seconds of replication lag, a replica behind more than this is not used:
+		'max_lag': 5.0
 	},
 	'session': {
 		'secret': 'AwEsOmE'
+	},
+	'template': {
+		'auto_reload': True,
+		'cache_dir': '',
+		'fragment_cache_dir': ''
+	},
+	'cache': {
+		# backend of model cache: '' for in-process LRU, or 'memcache://host:port', 'memcache://unix:/path':
+		'model_backend': '',
+		# memory bound of query result cache in each process:
+		'query_max_bytes': 32 * 1024 * 1024
+	},
+	'profiler': {
+		'enabled': True,
+		# explain and log statements slower than this:
+		'slow_seconds': 0.1,
+		# 'json' to use EXPLAIN FORMAT=JSON (MySQL 5.6+):
+		'explain_format': '',
+		# log the N+1 pattern if a request repeats the same query this many times, 0 to disable:
+		'detect_threshold': 5,
+		# raise error if a handler exceeds @query_budget:
+		'strict': True
+	},
+	'search': {
+		'index_file': ''
+	},
+	'write_behind': {
+		# queue inserts of comments and write them by batch, queued comments are lost if the process crashes:
+		'comments': False,
+		'batch_size': 100,
+		# seconds to wait for more rows before writing a batch:
+		'interval': 0.2,
+		'max_pending': 10000,
+		# seconds to wait if the queue is full, then insert directly:
+		'timeout': 1.0
+	},
+	'pageviews': {
+		# seconds between two writes of the views counted in each process:
+		'flush_interval': 10.0,
+		# seconds for the views to lose half weight in the ranking of popular blogs:
+		'hot_half_life': 86400.0
+	},
+	'metrics': {
+		# per-route request metrics exported by /metrics:
+		'enabled': True
+	},
+	'push': {
+		# seconds between heartbeats of idle event streams:
+		'heartbeat': 15.0,
+		# events waiting to be sent to one client, a slower client is disconnected:
+		'max_buffer': 100
 	}
 }
\ No newline at end of file
@@ -10,5 +10,16 @@ Override Configuration.
 configs = {
 	'db': {
 		'host': '127.0.0.1'
+	},
+	'template': {
+		'auto_reload': False,
+		'cache_dir': '/tmp/awesome-jinja2'
+	},
+	'profiler': {
+		'detect_threshold': 0,
+		'strict': False
+	},
+	'search': {
+		'index_file': '/tmp/awesome-search/index'
 	}
 }
\ No newline at end of file
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Index advisor: find the query patterns of this app, compare them with existing
+indexes and propose composite indexes.
+
+Query patterns come from static analysis of find_by/find_first/count_by and
+db.select calls in the modules of this directory, or from the profiler stats
+saved from /api/db-stats. Existing indexes come from the live 'SHOW INDEX', or
+from schema.sql without database:
+
+	python index_advisor.py
+	python index_advisor.py --stats db-stats.json
+	python index_advisor.py --schema ../schema.sql
+'''
+
+import os, re, ast, sys, json, glob
+
+_RE_SQL = re.compile(r'\bfrom\s+`?(\w+)`?(?:\s+where\s+(.*?))?(?:\s+order\s+by\s+(.*?))?(?:\s+limit\s+.*)?$', re.IGNORECASE | re.DOTALL)
+_RE_PREDICATE = re.compile(r'^\(?\s*`?(?:\w+\.)?(\w+)`?\s*(<=|>=|<>|!=|=|<|>|in\b|like\b|between\b)', re.IGNORECASE)
+_RE_AND = re.compile(r'\s+and\s+', re.IGNORECASE)
+_RE_OR = re.compile(r'\bor\b', re.IGNORECASE)
+
+def parse_sql(sql):
+	'''
+	Return (table, equality columns, range columns, order by columns) of a select,
+	or None if it cannot use an index.
+
+	>>> parse_sql('select * from `comments` where blog_id=? order by created_at desc limit 1000')
+	('comments', ['blog_id'], [], ['created_at'])
+	>>> parse_sql('select id, content from comments where id>? order by id limit ?')
+	('comments', [], ['id'], ['id'])
+	>>> parse_sql('select count(`id`) from `blogs`')
+	>>> parse_sql('select * from users where email=? or name=?')
+	'''
+	m = _RE_SQL.search(sql.strip())
+	if not m:
+		return None
+	table, where, order = m.groups()
+	equals, ranges, orders = [], [], []
+	if where:
+		if _RE_OR.search(where):
+			return None
+		for p in _RE_AND.split(where):
+			pm = _RE_PREDICATE.match(p.strip())
+			if not pm:
+				continue
+			column, op = pm.group(1), pm.group(2).lower()
+			if op in ('=', 'in'):
+				equals.append(column)
+			elif op in ('<', '>', '<=', '>=', 'between', 'like'):
+				ranges.append(column)
+	if order:
+		orders = [o.strip().split()[0].strip('`') for o in order.split(',')]
+	if not equals and not ranges and not orders:
+		return None
+	return table, equals, ranges, orders
+
+
+def propose(equals, ranges, orders):
+	'''
+	Return columns of index for the pattern: equality columns first, then the first
+	range column, or the order by columns if there is no range.
+
+	>>> propose(['blog_id'], [], ['created_at'])
+	('blog_id', 'created_at')
+	>>> propose(['user_id'], ['created_at'], ['id'])
+	('user_id', 'created_at')
+	'''
+	cols = []
+	for c in equals + (ranges[:1] if ranges else orders):
+		if not c in cols:
+			cols.append(c)
+	return tuple(cols)
+
+
+def covered(cols, indexes):
+	'''
+	Return name of the existing index that covers cols as its leading columns.
+
+	>>> covered(('blog_id', 'created_at'), dict(PRIMARY=['id'], idx_created_at=['created_at']))
+	>>> covered(('id',), dict(PRIMARY=['id']))
+	'PRIMARY'
+	'''
+	for name, index_cols in indexes.iteritems():
+		if tuple(index_cols[:len(cols)]) == cols:
+			return name
+	return None
+
+
+# ---------------------------- query patterns ----------------------------
+
+_FIND_METHODS = ('find_by', 'find_first', 'count_by')
+_SELECT_FUNCTIONS = ('select', 'select_one', 'select_int')
+
+def _model_tables():
+	import models
+	from transwarp.orm import Model
+	return dict((k, v.__table__) for k, v in vars(models).iteritems() if isinstance(v, type) and issubclass(v, Model) and v is not Model)
+
+
+def scan_sources(files):
+	'''
+	Return list of (sql, source) from calls with literal SQL in source files.
+	'''
+	tables = _model_tables()
+	L = []
+	for fpath in files:
+		with open(fpath) as f:
+			tree = ast.parse(f.read(), fpath)
+		for node in ast.walk(tree):
+			if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute) or not node.args or not isinstance(node.args[0], ast.Str):
+				continue
+			source = '%s:%d' % (os.path.basename(fpath), node.lineno)
+			obj, method, s = node.func.value, node.func.attr, node.args[0].s
+			if method in _FIND_METHODS and isinstance(obj, ast.Name) and obj.id in tables:
+				L.append(('select * from `%s` %s' % (tables[obj.id], s), source))
+			elif method in _SELECT_FUNCTIONS and isinstance(obj, ast.Name) and obj.id=='db':
+				L.append((s, source))
+	return L
+
+
+def load_stats(fpath):
+	'''
+	Return list of (sql, source) from JSON saved from /api/db-stats.
+	'''
+	with open(fpath) as f:
+		stats = json.load(f)
+	return [(s['fingerprint'], '%d calls, %.1f ms' % (s['count'], s['total'] * 1000)) for s in stats['statements']]
+
+
+# ---------------------------- existing indexes ----------------------------
+
+_RE_TABLE = re.compile(r'create\s+table\s+`?(\w+)`?\s*\((.*?)\)\s*engine', re.IGNORECASE | re.DOTALL)
+_RE_KEY = re.compile(r'(primary\s+key|(?:unique\s+)?key\s+`?(\w+)`?)\s*\(([^)]*)\)', re.IGNORECASE)
+
+def parse_schema(text):
+	'''
+	Return dict of table => dict of index name => columns from schema SQL.
+
+	>>> sorted(parse_schema('create table t (`id` int, key `idx_a_b` (`a`, `b`), primary key (`id`)) engine=innodb;')['t'].items())
+	[('PRIMARY', ['id']), ('idx_a_b', ['a', 'b'])]
+	'''
+	r = {}
+	for table, body in _RE_TABLE.findall(text):
+		indexes = r[table] = {}
+		for key, name, cols in _RE_KEY.findall(body):
+			indexes[name or 'PRIMARY'] = [c.strip(' `') for c in cols.split(',')]
+	return r
+
+
+def show_indexes(table):
+	from transwarp import db
+	indexes = {}
+	# replicas may not have applied the DDL yet:
+	with db.primary():
+		rows = db.select('show index from `%s`' % table)
+	for r in rows:
+		indexes.setdefault(r.Key_name, []).append((r.Seq_in_index, r.Column_name))
+	return dict((k, [c for seq, c in sorted(v)]) for k, v in indexes.iteritems())
+
+
+def estimate_selectivity(table, cols, sample=100000):
+	'''
+	Return (selectivity, rows per key) of cols on a sample of table by live database.
+	'''
+	from transwarp import db
+	columns = ', '.join('`%s`' % c for c in cols)
+	with db.primary():
+		r = db.select_one('select count(*) as total, count(distinct %s) as keys_ from (select %s from `%s` limit %d) s' % (columns, columns, table, sample))
+	if not r.total:
+		return None, None
+	return float(r.keys_) / r.total, float(r.total) / max(r.keys_, 1)
+
+
+# ---------------------------- report ----------------------------
+
+def advise(queries, get_indexes, estimate=None):
+	'''
+	Return list of proposals as dict(table, columns, sources, patterns, covered_by, selectivity, rows_per_key).
+
+	>>> L = advise([('select * from `comments` where blog_id=? order by created_at desc', 'urls.py:1')], lambda t: dict(PRIMARY=['id']))
+	>>> L[0]['table'], L[0]['columns'], L[0]['covered_by']
+	('comments', ('blog_id', 'created_at'), None)
+	'''
+	proposals = {}
+	cache = {}
+	for sql, source in queries:
+		parsed = parse_sql(sql)
+		if not parsed:
+			continue
+		table, equals, ranges, orders = parsed
+		cols = propose(equals, ranges, orders)
+		p = proposals.get((table, cols))
+		if p is None:
+			if not table in cache:
+				cache[table] = get_indexes(table)
+			p = proposals[(table, cols)] = dict(table=table, columns=cols, equals=tuple(equals), sources=[], patterns=set(), covered_by=covered(cols, cache[table]), selectivity=None, rows_per_key=None)
+		p['sources'].append(source)
+		p['patterns'].add(' '.join(sql.split()))
+	L = sorted(proposals.itervalues(), key=lambda p: (p['covered_by'] is not None, p['table'], p['columns']))
+	if estimate:
+		for p in L:
+			if p['covered_by'] is None:
+				# selectivity of the lookup part, or the whole index if there is no equality:
+				p['selectivity'], p['rows_per_key'] = estimate(p['table'], p['equals'] or p['columns'])
+	return L
+
+
+def report(proposals):
+	for p in proposals:
+		print '%s (%s):' % (p['table'], ', '.join(p['columns']))
+		for pattern in sorted(p['patterns']):
+			print '  query:    %s' % pattern
+		print '  from:     %s' % ', '.join(p['sources'])
+		if p['covered_by']:
+			print '  ok:       covered by index %s' % p['covered_by']
+		else:
+			if p['selectivity'] is not None:
+				print '  estimate: selectivity %.4f, ~%.1f rows per (%s)' % (p['selectivity'], p['rows_per_key'], ', '.join(p['equals'] or p['columns']))
+			print '  propose:  alter table `%s` add index `idx_%s` (%s);' % (p['table'], '_'.join(p['columns']), ', '.join('`%s`' % c for c in p['columns']))
+		print
+
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	if args and args[0]=='--test':
+		import doctest
+		doctest.testmod()
+		sys.exit(0)
+	opts = dict(zip(args[::2], args[1::2]))
+	if '--stats' in opts:
+		queries = load_stats(opts['--stats'])
+	else:
+		queries = scan_sources(sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))))
+	if '--schema' in opts:
+		with open(opts['--schema']) as f:
+			schema = parse_schema(f.read())
+		proposals = advise(queries, lambda t: schema.get(t, {}))
+	else:
+		from transwarp import db
+		from config import configs
+		db.create_engine(**configs.db)
+		proposals = advise(queries, show_indexes, estimate_selectivity)
+	report(proposals)
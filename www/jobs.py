@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Periodic jobs, run by cron, or repeatedly every N seconds with --every:
+
+	python jobs.py reconcile_comment_counts
+	python jobs.py reconcile_comment_counts --every 3600
+'''
+
+import sys, time, logging
+
+from transwarp import db
+from transwarp.cache import invalidate_fragments
+from config import configs
+
+from models import Blog
+
+
+def reconcile_comment_counts(batch_size=500, pause=0.1):
+	'''
+	Fix comment_count and last_commented_at of blogs which drift from comments,
+	scanning blogs by batch and sleeping pause seconds between batches. Return
+	number of fixed blogs.
+	'''
+	fixed = 0
+	last_id = ''
+	while True:
+		blogs = db.select('select id, comment_count, last_commented_at from blogs where id>? order by id limit ?', last_id, batch_size)
+		if not blogs:
+			break
+		ids = [b.id for b in blogs]
+		counts = dict((r.blog_id, r) for r in db.select('select blog_id, count(*) as n, max(created_at) as last from comments where blog_id in (%s) group by blog_id' % ','.join(['?'] * len(ids)), *ids))
+		for b in blogs:
+			r = counts.get(b.id)
+			n, last = (r.n, r.last) if r else (0, 0.0)
+			if b.comment_count==n and abs(b.last_commented_at - last) < 0.001:
+				continue
+			logging.warning('fix blog %s: comment_count %s => %s, last_commented_at %s => %s' % (b.id, b.comment_count, n, b.last_commented_at, last))
+			# count again in the update, comments may be written meanwhile:
+			db.update('update blogs set comment_count=(select count(*) from comments where blog_id=?), last_commented_at=(select coalesce(max(created_at), 0) from comments where blog_id=?) where id=?', b.id, b.id, b.id)
+			Blog.evict(b.id)
+			invalidate_fragments('blog:%s' % b.id)
+			fixed = fixed + 1
+		if len(blogs) < batch_size:
+			break
+		last_id = ids[-1]
+		time.sleep(pause)
+	if fixed:
+		invalidate_fragments('blogs')
+	return fixed
+
+
+_JOBS = dict(reconcile_comment_counts=reconcile_comment_counts)
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.WARNING)
+	args = sys.argv[1:]
+	if not args or not args[0] in _JOBS:
+		print 'usage: python jobs.py %s [--every seconds]' % '|'.join(sorted(_JOBS))
+		sys.exit(1)
+	job = _JOBS[args[0]]
+	every = float(args[2]) if len(args)==3 and args[1]=='--every' else 0
+	db.create_engine(**configs.db)
+	while True:
+		start = time.time()
+		print '%s: %s in %.1f s' % (args[0], job(), time.time() - start)
+		if not every:
+			break
+		time.sleep(max(0, every - (time.time() - start)))
@@ -10,10 +10,14 @@ Models for user, blog, comment.
 	不必关心数据库的时区以及时区转换问题，排序非常简单，显示的时候，只需要做一个float到str的转换，也非常容易。
 '''
 
-import time, uuid
+import time, uuid, json
 
+from transwarp import db, pubsub
 from transwarp.db import next_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from transwarp.orm import Model, StringField, BooleanField, FloatField, IntegerField, TextField
+from transwarp.cache import invalidate_fragments
+
+import search
 
 
 def next_id():
@@ -21,18 +25,24 @@ def next_id():
 
 class User(Model):
 	__table__ = 'users'
+	# fields never sent by JSON API:
+	__masked__ = ('password',)
+	# users are loaded by every request with session cookie:
+	__cache__ = dict(ttl=300, max_entries=1000)
 
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-	email = StringField(updatable=False, ddl='varchar(50)')
+	email = StringField(updatable=False, unique=True, ddl='varchar(50)')
 	password = StringField(ddl='varchar(50)')
 	admin = BooleanField()
 	name = StringField(ddl='varchar(50)')
 	image = StringField(ddl='varchar(500)')
-	created_at = FloatField(updatable=False, default=time.time)
+	created_at = FloatField(updatable=False, index=True, default=time.time)
 
 
 class Blog(Model):
 	__table__ = 'blogs'
+	__cache__ = dict(ttl=60, max_entries=500)
+
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
 	user_id = StringField(updatable=False, ddl='varchar(50)')
 	user_name = StringField(ddl='varchar(50)')
@@ -40,11 +50,44 @@ class Blog(Model):
 	name = StringField(ddl='varchar(50)')
 	summary = StringField(ddl='varchar(200)')
 	content = TextField()
-	created_at = FloatField(updatable=False, default=time.time)
+	created_at = FloatField(updatable=False, index=True, default=time.time)
+	# maintained by Comment in the same transaction, drift is fixed by jobs.py:
+	comment_count = IntegerField(updatable=False)
+	last_commented_at = FloatField(updatable=False)
+
+	def post_insert(self):
+		def _changed():
+			invalidate_fragments('blogs')
+			search.index_blog(self)
+		db.after_commit(_changed)
+
+	def post_update(self):
+		def _changed():
+			invalidate_fragments('blogs', 'blog:%s' % self.id)
+			search.index_blog(self)
+		db.after_commit(_changed)
+
+	def post_delete(self):
+		def _changed():
+			invalidate_fragments('blogs', 'blog:%s' % self.id)
+			search.remove_blog(self.id)
+		db.after_commit(_changed)
+
+
+class BlogView(Model):
+	# written by pageviews.py with 'insert ... on duplicate key update':
+	__table__ = 'blog_views'
+
+	blog_id = StringField(primary_key=True, ddl='varchar(50)')
+	views = IntegerField()
+	score = FloatField()
+	updated_at = FloatField()
 
 
 class Comment(Model):
 	__table__ = 'comments'
+	# comments of a blog are loaded by blog_id order by created_at:
+	__indexes__ = [('blog_id', 'created_at')]
 
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
 	blog_id = StringField(updatable=False, ddl='varchar(50)')
@@ -52,4 +95,22 @@ class Comment(Model):
 	user_name = StringField(ddl='varchar(50)')
 	user_image = StringField(ddl='varchar(500)')
 	content = TextField()
-	created_at = FloatField(updatable=False, default=time.time)
+	created_at = FloatField(updatable=False, index=True, default=time.time)
+
+	def post_insert(self):
+		db.update('update blogs set comment_count=comment_count+1, last_commented_at=greatest(last_commented_at, ?) where id=?', self.created_at, self.blog_id)
+		def _changed():
+			Blog.evict(self.blog_id)
+			invalidate_fragments('blogs', 'blog:%s' % self.blog_id)
+			search.index_comment(self)
+			# readers of the blog receive the comment from /api/blogs/:blog_id/comments/events:
+			pubsub.hub.publish('blog:%s' % self.blog_id, pubsub.sse_event(json.dumps(self), event='comment', id=repr(self.created_at)))
+		db.after_commit(_changed)
+
+	def post_delete(self):
+		db.update('update blogs set comment_count=greatest(comment_count-1, 0), last_commented_at=(select coalesce(max(created_at), 0) from comments where blog_id=?) where id=?', self.blog_id, self.blog_id)
+		def _changed():
+			Blog.evict(self.blog_id)
+			invalidate_fragments('blogs', 'blog:%s' % self.blog_id)
+			search.remove_comment(self.id)
+		db.after_commit(_changed)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Page views of blogs.
+
+Views are added up in memory of each process and flushed every
+configs.pageviews.flush_interval seconds, in one transaction, by multi-row
+'insert ... on duplicate key update' into table blog_views. Besides the total
+views, each row keeps a score which is halved every
+configs.pageviews.hot_half_life seconds, so recent views count more in the
+ranking of popular blogs.
+'''
+
+import time
+
+from transwarp import db
+from transwarp.writebehind import WriteBehindCounter
+from config import configs
+
+# rows of one insert statement:
+_BATCH_SIZE = 500
+
+# seconds to cache the ranking and the views of a blog:
+_CACHE_TTL = 60
+
+
+def _flush(counts):
+	now = time.time()
+	half_life = configs.pageviews.hot_half_life
+	# same order of rows in all processes, so concurrent flushes do not deadlock:
+	keys = sorted(counts)
+	# all chunks or none, the counter adds all counts back if it fails:
+	with db.transaction():
+		for i in xrange(0, len(keys), _BATCH_SIZE):
+			chunk = keys[i:i + _BATCH_SIZE]
+			args = []
+			for k in chunk:
+				args.extend([k, counts[k], counts[k], now])
+			args.append(half_life)
+			# the score is decayed to now before adding, updated_at must be assigned last:
+			db.update('insert into blog_views (`blog_id`, `views`, `score`, `updated_at`) values %s on duplicate key update `views`=`views`+values(`views`), `score`=`score`*pow(0.5, (values(`updated_at`)-`updated_at`)/?)+values(`score`), `updated_at`=values(`updated_at`)' % ','.join(['(?,?,?,?)'] * len(chunk)), *args)
+
+
+_counter = WriteBehindCounter(_flush, configs.pageviews.flush_interval)
+
+
+def record(blog_id):
+	'''
+	Count a view of blog, no database access.
+	'''
+	_counter.incr(blog_id)
+
+
+def views(blog_id):
+	'''
+	Return total views of blog, including views not flushed by current process.
+	'''
+	n = db.select_int('select coalesce(sum(`views`), 0) from blog_views where blog_id=?', blog_id, cache=_CACHE_TTL)
+	return n + _counter.pending(blog_id)
+
+
+def hot_blogs(limit=10):
+	'''
+	Return list of popular blogs as dict(id, name, views), ordered by score decayed to now.
+	'''
+	# score * 0.5 ^ ((now - updated_at) / half_life) has the same order as
+	# log2(score) + updated_at / half_life, which does not change with now so the
+	# result can be cached:
+	return db.select('select b.id, b.name, v.views from blog_views v join blogs b on b.id=v.blog_id order by log2(v.score) + v.updated_at / ? desc limit ?', configs.pageviews.hot_half_life, limit, cache=_CACHE_TTL)
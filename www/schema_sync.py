@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Compare tables of models with the live database, and add the missing indexes by
+online DDL (ALGORITHM=INPLACE, LOCK=NONE) so the table can still be read and
+written while the index is built:
+
+	python schema_sync.py            # show differences
+	python schema_sync.py migrate    # add missing indexes, fix uniqueness of changed ones
+
+Missing tables and columns are only reported with the SQL to create them.
+Indexes are added one by one with a pause between them, and the progress is
+printed every PROGRESS_INTERVAL seconds from performance_schema if available.
+The live schema and progress are always read from the primary, replicas may not
+have applied the DDL yet.
+'''
+
+import sys, time, logging, threading
+
+from transwarp import db
+from transwarp.orm import Model
+from config import configs
+
+import models
+
+# seconds between two progress lines:
+PROGRESS_INTERVAL = 10
+
+# seconds to pause between two DDL, let replicas catch up:
+PAUSE_SECONDS = 5
+
+# give up soon if the metadata lock is held by a long transaction, otherwise
+# all queries of the table wait behind the DDL:
+LOCK_WAIT_TIMEOUT = 5
+
+
+def _models():
+	L = [v for v in vars(models).itervalues() if isinstance(v, type) and issubclass(v, Model) and v is not Model]
+	return sorted(L, key=lambda m: m.__table__)
+
+
+def _show_indexes(table):
+	indexes = {}
+	with db.primary():
+		rows = db.select('show index from `%s`' % table)
+	for r in rows:
+		cols, unique = indexes.get(r.Key_name, ([], not r.Non_unique))
+		cols.append((r.Seq_in_index, r.Column_name))
+		indexes[r.Key_name] = (cols, unique)
+	return dict((k, (tuple(c for seq, c in sorted(cols)), unique)) for k, (cols, unique) in indexes.iteritems())
+
+
+def diff(model):
+	'''
+	Return dict(table, missing_table, missing_columns, missing_indexes, changed_indexes,
+	extra_indexes) of model compared with the live database. Indexes are compared
+	by columns and uniqueness, changed_indexes are (existing name, name, columns,
+	unique) of indexes on the same columns but different uniqueness.
+	'''
+	with db.primary():
+		return _diff(model)
+
+
+def _diff(model):
+	table = model.__table__
+	r = dict(table=table, missing_table=False, missing_columns=[], missing_indexes=[], changed_indexes=[], extra_indexes=[])
+	if not db.select_int('select count(*) from information_schema.tables where table_schema=database() and table_name=?', table):
+		r['missing_table'] = True
+		return r
+	columns = set(c.Field for c in db.select('show columns from `%s`' % table))
+	r['missing_columns'] = sorted((f for f in model.__mappings__.itervalues() if not f.name in columns), key=lambda f: f._order)
+	existing = dict((name, v) for name, v in _show_indexes(table).iteritems() if name!='PRIMARY')
+	wanted = set((cols, unique) for name, cols, unique in model.__table_indexes__)
+	# existing indexes not wanted by model:
+	unwanted = sorted((name, cols, unique) for name, (cols, unique) in existing.iteritems() if not (cols, unique) in wanted)
+	existing_values = set(existing.itervalues())
+	for name, cols, unique in model.__table_indexes__:
+		if (cols, unique) in existing_values:
+			continue
+		same_cols = [i for i in unwanted if i[1]==cols]
+		if same_cols:
+			unwanted.remove(same_cols[0])
+			r['changed_indexes'].append((same_cols[0][0], name, cols, unique))
+		else:
+			r['missing_indexes'].append((name, cols, unique))
+	r['extra_indexes'] = unwanted
+	return r
+
+
+def index_ddl(table, name, cols, unique, drop=None):
+	'''
+	Return online DDL that adds an index, and drops index drop in the same
+	statement, so the columns are always indexed.
+
+	>>> index_ddl('comments', 'idx_blog_id_created_at', ('blog_id', 'created_at'), False)
+	'alter table `comments` add index `idx_blog_id_created_at` (`blog_id`, `created_at`), algorithm=inplace, lock=none'
+	>>> index_ddl('users', 'idx_email', ('email',), True, drop='idx_email')
+	'alter table `users` drop index `idx_email`, add unique index `idx_email` (`email`), algorithm=inplace, lock=none'
+	'''
+	return 'alter table `%s` %sadd %sindex `%s` (%s), algorithm=inplace, lock=none' % (table, drop and 'drop index `%s`, ' % drop or '', unique and 'unique ' or '', name, ', '.join('`%s`' % c for c in cols))
+
+
+def _progress():
+	try:
+		with db.primary():
+			r = db.select_one('select work_completed, work_estimated from performance_schema.events_stages_current where event_name like ?', 'stage/innodb/alter%')
+	except Exception:
+		# performance_schema is disabled or not permitted:
+		return None
+	if r and r.work_estimated:
+		return 100.0 * r.work_completed / r.work_estimated
+	return None
+
+
+def _execute_ddl(sql):
+	result = {}
+	def _run():
+		try:
+			with db.connection():
+				db.update('set session lock_wait_timeout=%d' % LOCK_WAIT_TIMEOUT)
+				db.update(sql)
+		except Exception, e:
+			result['error'] = e
+	t = threading.Thread(target=_run)
+	t.daemon = True
+	start = time.time()
+	t.start()
+	while True:
+		t.join(PROGRESS_INTERVAL)
+		if not t.is_alive():
+			break
+		p = _progress()
+		print '  ... %.0f s%s' % (time.time() - start, '' if p is None else ', %.1f%%' % p)
+	if 'error' in result:
+		raise result['error']
+	return time.time() - start
+
+
+def migrate(diffs):
+	'''
+	Add missing indexes and change uniqueness of changed indexes, return number
+	of failed DDL.
+	'''
+	failed = 0
+	first = True
+	for d in diffs:
+		for drop, name, cols, unique in [(None, ) + i for i in d['missing_indexes']] + d['changed_indexes']:
+			if not first:
+				time.sleep(PAUSE_SECONDS)
+			first = False
+			sql = index_ddl(d['table'], name, cols, unique, drop)
+			print sql
+			try:
+				print '  done in %.1f s' % _execute_ddl(sql)
+			except Exception, e:
+				logging.exception('failed to add index %s on %s.' % (name, d['table']))
+				print '  failed: %s' % e
+				failed = failed + 1
+	return failed
+
+
+def report(model, d):
+	table = d['table']
+	if d['missing_table']:
+		print '%s: missing table' % table
+		print model().__sql__()
+		return
+	for f in d['missing_columns']:
+		print '%s: missing column, alter table `%s` add column `%s` %s%s;' % (table, table, f.name, f.ddl, '' if f.nullable else ' not null')
+	for name, cols, unique in d['missing_indexes']:
+		print '%s: missing index, %s;' % (table, index_ddl(table, name, cols, unique))
+	for drop, name, cols, unique in d['changed_indexes']:
+		print '%s: index %s should be %s, %s;' % (table, drop, 'unique' if unique else 'not unique', index_ddl(table, name, cols, unique, drop))
+	for name, cols, unique in d['extra_indexes']:
+		print '%s: index %s (%s) is not defined in model' % (table, name, ', '.join(cols))
+	if not d['missing_columns'] and not d['missing_indexes'] and not d['changed_indexes'] and not d['extra_indexes']:
+		print '%s: ok' % table
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1]=='--test':
+		import doctest
+		doctest.testmod()
+		sys.exit(0)
+	db.create_engine(**configs.db)
+	diffs = []
+	for m in _models():
+		d = diff(m)
+		report(m, d)
+		if not d['missing_table']:
+			diffs.append(d)
+	if len(sys.argv) > 1 and sys.argv[1]=='migrate':
+		sys.exit(1 if migrate(diffs) else 0)
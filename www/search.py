@@ -0,0 +1,560 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Full-text search over blogs and comments with an inverted index and BM25 ranking.
+
+English words are indexed as lowercase words, CJK text is indexed as single
+characters and overlapped bigrams (你好世界 => 你, 好, 世, 界, 你好, 好世, 世界),
+so no dictionary is needed. A query of CJK text is split into bigrams, or the
+character itself if it has only one.
+
+If configs.search.index_file is set, the index is shared by all worker processes
+on the host: 'rebuild' writes a snapshot file, and every write appends to a
+journal file which each process replays before searching. Once the journal is
+larger than _MAX_JOURNAL_BYTES, it is compacted into a new snapshot in the
+background. Otherwise each process builds its own index from database in the
+background after the first search.
+
+The index is never built from database in a request, search returns nothing
+until it is built. Rebuild the index from database, or compact the journal:
+
+	python search.py rebuild
+	python search.py compact
+'''
+
+import os, re, cgi, json, math, uuid, heapq, fcntl, marshal, logging, threading
+from array import array
+from itertools import izip
+from operator import itemgetter
+
+from transwarp import db
+from config import configs
+
+_RE_TOKEN = re.compile(u'[a-z0-9]+|[぀-ヿ㐀-鿿가-힯]+', re.UNICODE)
+
+# BM25 parameters:
+_K1 = 1.2
+_B = 0.75
+
+# journal size that triggers a new snapshot:
+_MAX_JOURNAL_BYTES = 16 * 1024 * 1024
+
+# compact in-process index if deleted documents are more than both this and the live ones:
+_MIN_DELETED = 1000
+
+
+def _to_unicode(s):
+	return s.decode('utf-8') if isinstance(s, str) else s
+
+
+def tokenize(text, query=False):
+	'''
+	Split text into index terms, or query terms if query is True.
+
+	>>> tokenize(u'Hello, World! \\u4f60\\u597d\\u4e16 & Python2')
+	[u'hello', u'world', u'\\u4f60', u'\\u597d', u'\\u4e16', u'\\u4f60\\u597d', u'\\u597d\\u4e16', u'python2']
+	>>> tokenize(u'\\u4f60\\u597d\\u4e16', query=True)
+	[u'\\u4f60\\u597d', u'\\u597d\\u4e16']
+	>>> tokenize(u'\\u597d', query=True)
+	[u'\\u597d']
+	'''
+	L = []
+	for w in _RE_TOKEN.findall(_to_unicode(text).lower()):
+		if w[0] < u'぀' or len(w)==1:
+			L.append(w)
+		else:
+			if not query:
+				# single characters for queries of one character:
+				L.extend(w)
+			L.extend([w[i:i+2] for i in xrange(len(w) - 1)])
+	return L
+
+
+class SearchIndex(object):
+	'''
+	In-memory inverted index. Postings are stored as compact arrays of document
+	numbers and term frequencies. A removed document is only marked as deleted
+	until the index is rebuilt.
+
+	>>> idx = SearchIndex()
+	>>> idx.add('a', u'Python web framework')
+	>>> idx.add('b', u'Python Python tutorial')
+	>>> idx.add('c', u'\\u6570\\u636e\\u5e93 database')
+	>>> [k for k, score in idx.search(u'python')]
+	['b', 'a']
+	>>> [k for k, score in idx.search(u'\\u6570\\u636e')]
+	['c']
+	>>> idx.remove('b')
+	>>> [k for k, score in idx.search(u'python tutorial')]
+	['a']
+	>>> idx.add('a', u'database')
+	>>> sorted(k for k, score in idx.search(u'database'))
+	['a', 'c']
+	>>> [k for k, score in idx.search(u'\\u636e')]
+	['c']
+	>>> len(idx), idx.deleted()
+	(2, 2)
+	>>> idx = idx.compact()
+	>>> len(idx), idx.deleted(), sorted(k for k, score in idx.search(u'database'))
+	(2, 0, ['a', 'c'])
+
+	All terms of the query are scored, even the common ones:
+
+	>>> idx = SearchIndex()
+	>>> idx.add('a', u'python web')
+	>>> idx.add('b', u'python')
+	>>> idx.add('c', u'python')
+	>>> idx.add('d', u'web')
+	>>> [k for k, score in idx.search(u'python web')]
+	['a', 'd', 'b', 'c']
+	'''
+	def __init__(self):
+		self._keys = [] # doc number => key, None if deleted
+		self._docs = {} # key => doc number
+		self._lengths = array('I')
+		self._total_length = 0
+		self._postings = {} # term => (array of doc numbers, array of term frequencies)
+		self._lock = threading.RLock()
+
+	def __len__(self):
+		return len(self._docs)
+
+	def deleted(self):
+		'''
+		Return number of deleted documents still kept in postings.
+		'''
+		return len(self._keys) - len(self._docs)
+
+	def add(self, key, text):
+		tokens = tokenize(text)
+		counts = {}
+		for t in tokens:
+			counts[t] = counts.get(t, 0) + 1
+		with self._lock:
+			self._remove(key)
+			n = len(self._keys)
+			self._keys.append(key)
+			self._docs[key] = n
+			self._lengths.append(len(tokens))
+			self._total_length = self._total_length + len(tokens)
+			for t, tf in counts.iteritems():
+				p = self._postings.get(t)
+				if p is None:
+					p = self._postings[t] = (array('I'), array('H'))
+				p[0].append(n)
+				p[1].append(min(tf, 65535))
+
+	def remove(self, key):
+		with self._lock:
+			self._remove(key)
+
+	def _remove(self, key):
+		n = self._docs.pop(key, None)
+		if n is not None:
+			self._keys[n] = None
+			self._total_length = self._total_length - self._lengths[n]
+
+	def search(self, q, limit=20):
+		'''
+		Return list of (key, score) ordered by BM25 score.
+		'''
+		terms = set(tokenize(q, query=True))
+		with self._lock:
+			N = len(self._docs)
+			if not terms or not N:
+				return []
+			avgdl = float(self._total_length) / N or 1.0
+			keys = self._keys
+			lengths = self._lengths
+			scores = {}
+			for p in (self._postings[t] for t in terms if t in self._postings):
+				# df also counts deleted documents until compacted:
+				df = min(len(p[0]), N)
+				idf = math.log(1.0 + (N - df + 0.5) / (df + 0.5))
+				for n, tf in izip(p[0], p[1]):
+					if keys[n] is None:
+						continue
+					norm = _K1 * (1.0 - _B + _B * lengths[n] / avgdl)
+					scores[n] = scores.get(n, 0.0) + idf * tf * (_K1 + 1.0) / (tf + norm)
+			top = heapq.nlargest(limit, scores.iteritems(), key=itemgetter(1))
+			return [(keys[n], score) for n, score in top]
+
+	def compact(self):
+		'''
+		Return a copy without deleted documents.
+		'''
+		with self._lock:
+			index = SearchIndex()
+			numbers = {} # old doc number => new doc number
+			for n, key in enumerate(self._keys):
+				if key is not None:
+					numbers[n] = len(index._keys)
+					index._keys.append(key)
+					index._lengths.append(self._lengths[n])
+			index._docs = dict((k, n) for n, k in enumerate(index._keys))
+			index._total_length = self._total_length
+			for t, (docs, tfs) in self._postings.iteritems():
+				p = (array('I'), array('H'))
+				for n, tf in izip(docs, tfs):
+					m = numbers.get(n)
+					if m is not None:
+						p[0].append(m)
+						p[1].append(tf)
+				if p[0]:
+					index._postings[t] = p
+			return index
+
+	def dump(self, f):
+		with self._lock:
+			postings = dict((t, (p[0].tostring(), p[1].tostring())) for t, p in self._postings.iteritems())
+			marshal.dump(dict(keys=self._keys, lengths=self._lengths.tostring(), postings=postings), f)
+
+	@classmethod
+	def load(cls, f):
+		d = marshal.load(f)
+		index = cls()
+		index._keys = d['keys']
+		index._docs = dict((k, n) for n, k in enumerate(index._keys) if k is not None)
+		index._lengths.fromstring(d['lengths'])
+		index._total_length = sum(index._lengths[n] for n in index._docs.itervalues())
+		for t, (docs, tfs) in d['postings'].iteritems():
+			p = index._postings[t] = (array('I'), array('H'))
+			p[0].fromstring(docs)
+			p[1].fromstring(tfs)
+		return index
+
+
+class IndexStore(object):
+	'''
+	Holds the SearchIndex of current process. With a path, the index is loaded from
+	snapshot file and kept up to date by replaying the journal file, so writes in
+	any process are seen by all. Without a path, the index is built from database
+	in background on first use and writes only apply to current process.
+
+	Readers hold a shared lock of the journal, writers and compaction an exclusive one.
+	'''
+	def __init__(self, path=None):
+		self._path = path
+		self._journal = path and '%s.journal' % path
+		# empty until loaded or built:
+		self._index = SearchIndex()
+		self._version = None # (inode, mtime) of loaded snapshot
+		self._offset = 0
+		self._building = False
+		self._built = False
+		self._pending = [] # entries written while building
+		self._compacting = False
+		self._warned = False
+		self._lock = threading.Lock()
+
+	def get_index(self):
+		with self._lock:
+			if self._path:
+				self._refresh()
+			elif not self._built and not self._building:
+				self._building = True
+				_start_thread(self._build)
+			return self._index
+
+	def _build(self):
+		try:
+			with db.connection():
+				index = _build_from_db()
+		except Exception:
+			logging.exception('failed to build search index.')
+			with self._lock:
+				self._building = False
+				self._pending = []
+			return
+		with self._lock:
+			# writes during the build may not be read from database:
+			for entry in self._pending:
+				_apply(index, entry)
+			self._pending = []
+			self._index = index
+			self._building = False
+			self._built = True
+
+	def _refresh(self):
+		if not os.path.isfile(self._path):
+			if not self._warned:
+				self._warned = True
+				logging.warning('search index %s not found, build it by: python search.py rebuild' % self._path)
+			return
+		with open(self._journal, 'a+b') as f:
+			fcntl.flock(f, fcntl.LOCK_SH)
+			try:
+				self._replay(f)
+			finally:
+				fcntl.flock(f, fcntl.LOCK_UN)
+
+	def _replay(self, f):
+		# called with the journal locked:
+		st = os.stat(self._path)
+		version = (st.st_ino, st.st_mtime)
+		size = os.fstat(f.fileno()).st_size
+		if version != self._version or size < self._offset:
+			logging.info('load search index from %s...' % self._path)
+			with open(self._path, 'rb') as sf:
+				self._index = SearchIndex.load(sf)
+			self._version = version
+			self._offset = 0
+		if size > self._offset:
+			f.seek(self._offset)
+			for line in f:
+				if not line.endswith('\n'):
+					# partially written:
+					break
+				self._offset = self._offset + len(line)
+				_apply(self._index, json.loads(line))
+
+	def write(self, entry):
+		if self._path:
+			if not os.path.isfile(self._journal):
+				# not built yet, the journal is created once a rebuild starts:
+				return
+			with open(self._journal, 'ab') as f:
+				fcntl.flock(f, fcntl.LOCK_EX)
+				try:
+					f.write(json.dumps(entry) + '\n')
+					f.flush()
+					size = os.fstat(f.fileno()).st_size
+				finally:
+					fcntl.flock(f, fcntl.LOCK_UN)
+			if size > _MAX_JOURNAL_BYTES:
+				with self._lock:
+					if self._compacting:
+						return
+					self._compacting = True
+				_start_thread(self._compact_in_background)
+		else:
+			with self._lock:
+				if self._building:
+					self._pending.append(entry)
+				elif self._built:
+					_apply(self._index, entry)
+					if self._index.deleted() > max(len(self._index), _MIN_DELETED):
+						self._index = self._index.compact()
+
+	def _compact_in_background(self):
+		try:
+			self.compact()
+		except Exception:
+			logging.exception('failed to compact search index.')
+		finally:
+			with self._lock:
+				self._compacting = False
+
+	def compact(self):
+		'''
+		Write the index with the journal applied as a new snapshot, without deleted
+		documents, and clear the journal.
+		'''
+		with _FileLock('%s.lock' % self._path), self._lock:
+			with open(self._journal, 'a+b') as f:
+				fcntl.flock(f, fcntl.LOCK_EX)
+				try:
+					self._replay(f)
+					index = self._index.compact()
+					_write_snapshot(self._path, index, f)
+					st = os.stat(self._path)
+					self._index = index
+					self._version = (st.st_ino, st.st_mtime)
+					self._offset = 0
+				finally:
+					fcntl.flock(f, fcntl.LOCK_UN)
+			logging.info('search index compacted with %d documents.' % len(index))
+			return index
+
+
+class _FileLock(object):
+	'''
+	Exclusive lock of a file, so rebuild and compaction of an index never run at
+	the same time, while writers still append to the journal.
+	'''
+	def __init__(self, path):
+		self._path = path
+
+	def __enter__(self):
+		self._f = open(self._path, 'ab')
+		fcntl.flock(self._f, fcntl.LOCK_EX)
+		return self
+
+	def __exit__(self, exctype, excvalue, traceback):
+		fcntl.flock(self._f, fcntl.LOCK_UN)
+		self._f.close()
+
+
+def _start_thread(target):
+	t = threading.Thread(target=target)
+	t.daemon = True
+	t.start()
+
+
+def _apply(index, entry):
+	if entry['op']=='add':
+		index.add(entry['key'], entry['text'])
+	else:
+		index.remove(entry['key'])
+
+
+def _iter_rows(sql, batch_size=1000):
+	last_id = ''
+	while True:
+		L = db.select(sql, last_id, batch_size)
+		for r in L:
+			yield r
+		if len(L) < batch_size:
+			break
+		last_id = L[-1].id
+
+
+def _blog_text(blog):
+	return u'\n'.join([_to_unicode(blog.name), _to_unicode(blog.summary), _to_unicode(blog.content)])
+
+
+def _build_from_db():
+	logging.info('build search index from database...')
+	index = SearchIndex()
+	for b in _iter_rows('select id, name, summary, content from blogs where id>? order by id limit ?'):
+		index.add('blog:%s' % b.id, _blog_text(b))
+	for c in _iter_rows('select id, content from comments where id>? order by id limit ?'):
+		index.add('comment:%s' % c.id, c.content)
+	logging.info('search index built with %d documents.' % len(index))
+	return index
+
+
+def _write_snapshot(path, index, journal):
+	# replace snapshot and clear the journal, called with the journal locked:
+	tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+	with open(tmp, 'wb') as f:
+		index.dump(f)
+	os.rename(tmp, path)
+	journal.truncate(0)
+
+
+def rebuild(path=None):
+	'''
+	Build index from database and write it as the snapshot file, the journal is
+	cleared. Writes journaled while reading the database are applied to the new
+	index, the journal is not locked during the build.
+	'''
+	path = path or configs.search.index_file
+	if not path:
+		return _build_from_db()
+	d = os.path.dirname(path)
+	if d and not os.path.isdir(d):
+		os.makedirs(d)
+	with _FileLock('%s.lock' % path):
+		# writers append to the journal once it exists:
+		with open('%s.journal' % path, 'a+b') as f:
+			fcntl.flock(f, fcntl.LOCK_SH)
+			start = os.fstat(f.fileno()).st_size
+			fcntl.flock(f, fcntl.LOCK_UN)
+			index = _build_from_db()
+			fcntl.flock(f, fcntl.LOCK_EX)
+			try:
+				f.seek(start)
+				for line in f:
+					if not line.endswith('\n'):
+						break
+					_apply(index, json.loads(line))
+				_write_snapshot(path, index, f)
+			finally:
+				fcntl.flock(f, fcntl.LOCK_UN)
+	return index
+
+
+_store = IndexStore(configs.search.index_file or None)
+
+
+def _write(entry):
+	# search index must not break the write of model:
+	try:
+		_store.write(entry)
+	except Exception:
+		logging.exception('failed to update search index.')
+
+
+def index_blog(blog):
+	_write(dict(op='add', key='blog:%s' % blog.id, text=_blog_text(blog)))
+
+
+def index_comment(comment):
+	_write(dict(op='add', key='comment:%s' % comment.id, text=_to_unicode(comment.content)))
+
+
+def remove_blog(blog_id):
+	_write(dict(op='remove', key='blog:%s' % blog_id))
+
+
+def remove_comment(comment_id):
+	_write(dict(op='remove', key='comment:%s' % comment_id))
+
+
+def highlight(text, q, width=120):
+	'''
+	Return html snippet of text around the first match of q, with matches wrapped by <em>.
+
+	>>> highlight(u'<b>Learn</b> Python the hard way', u'python', 20)
+	u'...&lt;/b&gt; <em>Python</em> the hard...'
+	>>> highlight(u'abc', u'xyz')
+	u'abc'
+	'''
+	text = _to_unicode(text)
+	terms = sorted(set(tokenize(q, query=True)), key=len, reverse=True)
+	m = terms and re.search(u'|'.join(re.escape(t) for t in terms), text, re.IGNORECASE | re.UNICODE)
+	start = max(0, m.start() - width // 4) if m else 0
+	s = text[start:start + width]
+	r = cgi.escape(s)
+	if terms:
+		r = re.sub(u'(%s)' % u'|'.join(re.escape(cgi.escape(t)) for t in terms), u'<em>\\1</em>', r, flags=re.IGNORECASE | re.UNICODE)
+	return u'%s%s%s' % (u'...' if start > 0 else u'', r, u'...' if start + width < len(text) else u'')
+
+
+def _select_in(sql, ids):
+	if not ids:
+		return {}
+	return dict((r.id, r) for r in db.select(sql % ','.join(['?'] * len(ids)), *ids))
+
+
+def search(q, limit=20):
+	'''
+	Search blogs and comments, return list of dict with type, id, blog_id, title, snippet and score.
+	'''
+	hits = _store.get_index().search(q, limit)
+	blog_ids = [k[5:] for k, score in hits if k.startswith('blog:')]
+	comment_ids = [k[8:] for k, score in hits if k.startswith('comment:')]
+	comments = _select_in('select id, blog_id, content from comments where id in (%s)', comment_ids)
+	blogs = _select_in('select id, name, summary, content from blogs where id in (%s)', list(set(blog_ids + [c.blog_id for c in comments.itervalues()])))
+	results = []
+	for key, score in hits:
+		kind, id = key.split(':', 1)
+		if kind=='blog':
+			b = blogs.get(id)
+			if b:
+				results.append(dict(type=kind, id=id, blog_id=id, title=b.name, snippet=highlight(_blog_text(b), q), score=score))
+		else:
+			c = comments.get(id)
+			b = c and blogs.get(c.blog_id)
+			if b:
+				results.append(dict(type=kind, id=id, blog_id=b.id, title=b.name, snippet=highlight(c.content, q), score=score))
+	return results
+
+
+if __name__ == '__main__':
+	import sys
+	logging.basicConfig(level=logging.INFO)
+	if len(sys.argv) == 2 and sys.argv[1]=='rebuild':
+		db.create_engine(**configs.db)
+		index = rebuild()
+		print 'search index rebuilt with %d documents.' % len(index)
+	elif len(sys.argv) == 2 and sys.argv[1]=='compact':
+		index = IndexStore(configs.search.index_file).compact()
+		print 'search index compacted with %d documents.' % len(index)
+	else:
+		import doctest
+		doctest.testmod()
@@ -48,6 +48,12 @@ function postApi(url, data, callback) {
     _ajax('POST', url, data, callback);
 }
 
+// send several api calls in one request, requests: [{method: 'GET', path: '/api/blogs', params: {page: 2}}, ...]
+// callback(err, results) with results: [{status: 200, body: {...}}, ...]
+function batchApi(requests, callback) {
+    _ajax('POST', '/api/batch', {requests: JSON.stringify(requests)}, callback);
+}
+
 function startLoading() {
     var btn = $('form').find('button[type=submit]');
     var icon = btn.find('i');
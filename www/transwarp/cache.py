@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Cache module with pluggable backends. This module is independent with web and db module.
+
+A backend object has 3 methods:
+
+	get(key) ==> value or None
+	set(key, value, ttl=0) ==> None, ttl in seconds and 0 means never expires
+	delete(key) ==> None
+'''
+
+import os, time, uuid, socket, hashlib, logging, threading, cPickle as pickle
+from collections import OrderedDict
+
+
+class LRUCache(object):
+	'''
+	In-process cache that holds at most max_entries items.
+
+	>>> c = LRUCache(2)
+	>>> c.set('a', 1)
+	>>> c.set('b', 2)
+	>>> c.get('a')
+	1
+	>>> c.set('c', 3)
+	>>> c.get('b')
+	>>> c.get('a'), c.get('c')
+	(1, 3)
+	>>> c.set('d', 4, ttl=-1)
+	>>> c.get('d')
+	>>> c.delete('a')
+	>>> c.get('a')
+	'''
+	def __init__(self, max_entries=1000):
+		self._max_entries = max_entries
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._data.pop(key, None)
+			if entry is None:
+				return None
+			expires, value = entry
+			if expires and expires < time.time():
+				return None
+			# move to the end as the most recently used:
+			self._data[key] = entry
+			return value
+
+	def set(self, key, value, ttl=0):
+		expires = time.time() + ttl if ttl else 0
+		with self._lock:
+			self._data.pop(key, None)
+			self._data[key] = (expires, value)
+			while len(self._data) > self._max_entries:
+				self._data.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._data.pop(key, None)
+
+	def __len__(self):
+		return len(self._data)
+
+
+class FileCache(object):
+	'''
+	Cache that stores each item as a pickled file in a local directory, so it can
+	be shared by all worker processes on the same host.
+
+	>>> import tempfile, shutil
+	>>> d = tempfile.mkdtemp()
+	>>> c = FileCache(d)
+	>>> c.set(u'中文', dict(x=1))
+	>>> c.get(u'中文')
+	{'x': 1}
+	>>> c.set('old', 1, ttl=-1)
+	>>> c.get('old')
+	>>> c.delete(u'中文')
+	>>> c.get(u'中文')
+	>>> shutil.rmtree(d)
+	'''
+	def __init__(self, cache_dir):
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		self._cache_dir = cache_dir
+
+	def _path(self, key):
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		return os.path.join(self._cache_dir, hashlib.md5(key).hexdigest())
+
+	def get(self, key):
+		path = self._path(key)
+		try:
+			with open(path, 'rb') as f:
+				expires, value = pickle.load(f)
+		except (IOError, EOFError, pickle.UnpicklingError):
+			return None
+		if expires and expires < time.time():
+			self.delete(key)
+			return None
+		return value
+
+	def set(self, key, value, ttl=0):
+		expires = time.time() + ttl if ttl else 0
+		path = self._path(key)
+		tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+		with open(tmp, 'wb') as f:
+			pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+		# rename is atomic so readers never see a partial file:
+		os.rename(tmp, path)
+
+	def delete(self, key):
+		try:
+			os.remove(self._path(key))
+		except OSError:
+			pass
+
+
+class SocketCache(object):
+	'''
+	Cache stored in a memcached server, so it can be shared by all worker processes.
+	The address is 'host:port' or 'unix:/path/to/socket'. Each thread keeps its own
+	connection. Errors of server are logged and treated as cache miss.
+
+	c = SocketCache('unix:/var/run/memcached/memcached.sock')
+	'''
+	def __init__(self, address='127.0.0.1:11211', timeout=0.5):
+		if address.startswith('unix:'):
+			self._family, self._address = socket.AF_UNIX, address[5:]
+		else:
+			host, port = address.rsplit(':', 1)
+			self._family, self._address = socket.AF_INET, (host, int(port))
+		self._timeout = timeout
+		self._local = threading.local()
+
+	def _key(self, key):
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		# memcached key cannot contain spaces and is limited to 250 bytes:
+		return hashlib.md5(key).hexdigest()
+
+	def _call(self, cmd, data=None):
+		f = getattr(self._local, 'file', None)
+		try:
+			if f is None:
+				sock = socket.socket(self._family, socket.SOCK_STREAM)
+				sock.settimeout(self._timeout)
+				sock.connect(self._address)
+				f = self._local.file = sock.makefile('rwb')
+				sock.close()
+			f.write(cmd + '\r\n')
+			if data is not None:
+				f.write(data + '\r\n')
+			f.flush()
+			line = f.readline()
+			if not cmd.startswith('get '):
+				return line.rstrip('\r\n')
+			if not line.startswith('VALUE '):
+				return None
+			value = f.read(int(line.split()[3]) + 2)[:-2]
+			f.readline() # END
+			return value
+		except (socket.error, IOError, ValueError, IndexError), e:
+			logging.warning('cache server error: %s' % e)
+			self._local.file = None
+			if f is not None:
+				f.close()
+			return None
+
+	def get(self, key):
+		value = self._call('get %s' % self._key(key))
+		return None if value is None else pickle.loads(value)
+
+	def set(self, key, value, ttl=0):
+		data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+		# a negative exptime expires the item immediately:
+		self._call('set %s 0 %d %d' % (self._key(key), ttl, len(data)), data)
+
+	def delete(self, key):
+		self._call('delete %s' % self._key(key))
+
+
+def create_backend(url, max_entries=1000):
+	'''
+	Create backend by url: '' for LRUCache, 'file:/path/to/dir' for FileCache,
+	'memcache://host:port' or 'memcache://unix:/path/to/socket' for SocketCache.
+
+	>>> create_backend('').__class__.__name__
+	'LRUCache'
+	>>> create_backend('memcache://unix:/tmp/memcached.sock')._address
+	'/tmp/memcached.sock'
+	'''
+	if not url:
+		return LRUCache(max_entries)
+	if url.startswith('file:'):
+		return FileCache(url[5:])
+	if url.startswith('memcache://'):
+		return SocketCache(url[11:])
+	raise ValueError('Invalid cache url: %s' % url)
+
+
+class TaggedCache(object):
+	'''
+	Cache on top of a backend that supports invalidation by tags.
+
+	Every tag has a version stored in the backend. An item remembers the versions of
+	its tags when it is set, and becomes invalid once any of the tags is invalidated.
+
+	>>> c = TaggedCache(LRUCache())
+	>>> c.set('blog:1:comments', u'<ul></ul>', tags=('blog:1',))
+	>>> c.set('blog:2:comments', u'<ul></ul>', tags=('blog:2',))
+	>>> c.get('blog:1:comments')
+	u'<ul></ul>'
+	>>> c.invalidate('blog:1')
+	>>> c.get('blog:1:comments')
+	>>> c.get('blog:2:comments')
+	u'<ul></ul>'
+
+	Read the versions before building the value, then an invalidation in between
+	is not lost:
+
+	>>> versions = c.versions(('blog:2',))
+	>>> c.invalidate('blog:2')
+	>>> c.set('blog:2:comments', u'<ul>stale</ul>', versions=versions)
+	>>> c.get('blog:2:comments')
+	'''
+	def __init__(self, backend):
+		self.backend = backend
+
+	def _version(self, tag):
+		key = '__tag__:%s' % tag
+		v = self.backend.get(key)
+		if v is None:
+			# a missing version (never set or evicted) must not match any stored item:
+			v = uuid.uuid4().hex
+			self.backend.set(key, v)
+		return v
+
+	def get(self, key):
+		entry = self.backend.get(key)
+		if entry is None:
+			return None
+		value, tags = entry
+		for tag, version in tags:
+			if self._version(tag) != version:
+				return None
+		return value
+
+	def versions(self, tags):
+		'''
+		Return current versions of tags, pass them to set() if the value is built
+		after reading them.
+		'''
+		return [(tag, self._version(tag)) for tag in tags]
+
+	def set(self, key, value, ttl=0, tags=(), versions=None):
+		if versions is None:
+			versions = self.versions(tags)
+		self.backend.set(key, (value, versions), ttl)
+
+	def delete(self, key):
+		self.backend.delete(key)
+
+	def invalidate(self, *tags):
+		for tag in tags:
+			logging.info('invalidate cache tag: %s' % tag)
+			self.backend.set('__tag__:%s' % tag, uuid.uuid4().hex)
+
+
+# global cache for rendered template fragments, the backend can be replaced at startup:
+fragments = TaggedCache(LRUCache(1000))
+
+
+def invalidate_fragments(*tags):
+	'''
+	Invalidate cached template fragments by tags. Called by model writes.
+	'''
+	fragments.invalidate(*tags)
+
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -7,7 +7,10 @@ __author__ = 'Jack Bai'
 Database operation moudule
 '''
 
-import threading, time, logging, uuid, functools
+import re, sys, json, Queue, atexit, random, threading, time, logging, uuid, hashlib, functools
+from collections import OrderedDict
+
+import profiler
 
 # Dict object:
 
@@ -70,7 +73,7 @@ def next_id(t=None):
 
 def _profiling(start, sql=''):
 	t = time.time() - start
-	if t > 0.1:
+	if t > profiler.slow_seconds:
 		logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
 	else:
 		logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
@@ -97,10 +100,13 @@ class _LasyConnection(object):
 		return self.connection.cursor()
 
 	def commit(self):
-		self.connection.commit()
+		# nothing to commit if no statement is executed:
+		if self.connection:
+			self.connection.commit()
 
 	def rollback(self):
-		self.connection.rollback()
+		if self.connection:
+			self.connection.rollback()
 
 	def cleanup(self):
 		if self.connection:
@@ -117,6 +123,23 @@ class _DbCtx(threading.local):
 	def __init__(self):
 		self.connection = None
 		self.transactions = 0
+		# dict of loaded objects used by orm, None if not enabled:
+		self.identity_map = None
+		# tables written in current transaction:
+		self.written_tables = set()
+		# functions to call after current transaction commits:
+		self.after_commit = []
+		# error that rolled back current transaction on the server, it can only roll back:
+		self.doomed = None
+		# lazy connection to replica for select outside transaction:
+		self.replica = None
+		# depth of read_your_writes() contexts, and whether a write is done in it:
+		self.sessions = 0
+		self.wrote = False
+		# depth of primary() contexts:
+		self.primary = 0
+		# whether the last select is read from a replica:
+		self.replica_read = False
 
 	def is_init(self):
 		return not self.connection is None
@@ -129,6 +152,9 @@ class _DbCtx(threading.local):
 	def cleanup(self):
 		self.connection.cleanup()
 		self.connection = None
+		if self.replica:
+			self.replica.cleanup()
+			self.replica = None
 
 	def cursor():
 		'''
@@ -147,16 +173,105 @@ class _Engine(object):
 	'''
 	_Engine is a SQL engine object
 	'''
-	def __init__(self, connect):
+	def __init__(self, connect, replicas=()):
 		self._connect = connect
+		self.replicas = list(replicas)
 
 	def connect(self):
 		return self._connect()
-		
 
-def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
+
+# set by configuration, replica behind primary more than this is not used:
+max_replica_lag = 5.0
+
+# seconds between two checks of replication lag of a replica:
+_LAG_CHECK_INTERVAL = 5.0
+
+# seconds to skip a replica after it failed:
+_REPLICA_RETRY_SECONDS = 30.0
+
+class _Replica(object):
+	'''
+	A read replica with its last known replication lag.
+	'''
+	def __init__(self, name, connect):
+		self.name = name
+		self.connect = connect
+		# None if replication is stopped or unknown:
+		self.lag = None
+		self.checked_at = 0.0
+		self.down_until = 0.0
+
+	def check_lag(self, connection):
+		cursor = connection.cursor()
+		try:
+			cursor.execute('show slave status')
+			values = cursor.fetchone()
+			status = Dict([x[0] for x in cursor.description], values) if values else {}
+		finally:
+			cursor.close()
+		self.lag = status.get('Seconds_Behind_Master')
+		self.checked_at = time.time()
+
+
+def _connect_replica():
+	'''
+	Return (replica, connection) of a random replica which is up and not lagging,
+	or (None, None).
+	'''
+	now = time.time()
+	candidates = [r for r in engine.replicas if r.down_until <= now and (now - r.checked_at >= _LAG_CHECK_INTERVAL or (r.lag is not None and r.lag <= max_replica_lag))]
+	random.shuffle(candidates)
+	for r in candidates:
+		connection = None
+		try:
+			connection = r.connect()
+			if now - r.checked_at >= _LAG_CHECK_INTERVAL:
+				r.check_lag(connection)
+			if r.lag is not None and r.lag <= max_replica_lag:
+				logging.info('open replica connection <%s> to %s...' % (hex(id(connection)), r.name))
+				return r, connection
+			logging.warning('skip replica %s, lag: %s' % (r.name, r.lag))
+		except Exception, e:
+			logging.warning('replica %s is down: %s' % (r.name, e))
+			r.down_until = now + _REPLICA_RETRY_SECONDS
+		if connection:
+			connection.close()
+	return None, None
+
+
+def _read_connection():
+	'''
+	Return lazy connection for select: a replica outside transaction and before
+	any write in the read_your_writes() context, otherwise the primary, or always
+	the primary in primary() context.
+	'''
+	global _db_ctx
+	if _db_ctx.transactions > 0 or _db_ctx.wrote or _db_ctx.primary or not engine.replicas:
+		return _db_ctx.connection
+	if _db_ctx.replica is None:
+		replica, connection = _connect_replica()
+		if connection is None:
+			# fail over to primary:
+			return _db_ctx.connection
+		_db_ctx.replica = _LasyConnection()
+		_db_ctx.replica.connection = connection
+		_db_ctx.replica.replica = replica
+	return _db_ctx.replica
+
+
+def _is_connection_error(e):
+	# errors of mysql.connector that mean the server is gone, not a bad statement:
+	return e.__class__.__name__ in ('InterfaceError', 'OperationalError')
+
+
+def create_engine(user, password, database, host='127.0.0.1', port=3306, replicas=(), max_lag=None, **kw):
+	'''
+	Create the engine to primary database. Each of replicas is a dict like
+	dict(host='10.0.0.2', port=3306) which overrides params of the primary.
+	'''
 	import mysql.connector
-	global engine
+	global engine, max_replica_lag
 	if engine is not None:
 		raise DBError('Engine is already initialized')
 	params = dict(user=user, password=password, database=database, host=host, port=port)
@@ -165,9 +280,15 @@ def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
 		params[k] = kw.pop(k, v)
 	params.update(kw)
 	params['buffered'] = True
-	engine = _Engine(lambda:mysql.connector.connect(**params))
+	L = []
+	for r in replicas:
+		replica_params = dict(params, **r)
+		L.append(_Replica('%s:%s' % (replica_params['host'], replica_params['port']), lambda p=replica_params: mysql.connector.connect(**p)))
+	if max_lag is not None:
+		max_replica_lag = max_lag
+	engine = _Engine(lambda:mysql.connector.connect(**params), L)
 	# test connection...
-	logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+	logging.info('Init mysql engine <%s> with %d replicas ok.' % (hex(id(engine)), len(L)))
 
 
 class _ConnectionCtx(object):
@@ -212,9 +333,170 @@ def with_connection(func):
 	return _wrapper
 
 
+class _IdentityMapCtx(object):
+	'''
+	_IdentityMapCtx object that enables identity map in current thread, the map is
+	cleared when the most outer context exits, or when the context exits if fresh.
+	'''
+	def __init__(self, fresh=False):
+		self.fresh = fresh
+
+	def __enter__(self):
+		global _db_ctx
+		self.saved = _db_ctx.identity_map
+		self.should_cleanup = self.fresh or self.saved is None
+		if self.should_cleanup:
+			_db_ctx.identity_map = {}
+		return self
+
+	def __exit__(self, exctype, excvalue, traceback):
+		global _db_ctx
+		if self.should_cleanup:
+			_db_ctx.identity_map = self.saved
+
+
+def identity_map(fresh=False):
+	'''
+	Return _IdentityMapCtx object that can be used by 'with' statement. Objects
+	loaded by primary key in the context are kept in the map, so loading the same
+	row again returns the same object without query. With fresh=True the context
+	uses its own map even inside another one, e.g. for a sub request.
+
+	with db.identity_map():
+		User.get(id) is User.get(id) # True, only 1 query
+	'''
+	return _IdentityMapCtx(fresh)
+
+
+class _ReadYourWritesCtx(object):
+	'''
+	_ReadYourWritesCtx object that sends select to the primary after a write in
+	current thread, until the most outer context exits.
+	'''
+	def __enter__(self):
+		global _db_ctx
+		if _db_ctx.sessions==0:
+			_db_ctx.wrote = False
+		_db_ctx.sessions = _db_ctx.sessions + 1
+		return self
+
+	def __exit__(self, exctype, excvalue, traceback):
+		global _db_ctx
+		_db_ctx.sessions = _db_ctx.sessions - 1
+		if _db_ctx.sessions==0:
+			_db_ctx.wrote = False
+
+
+def read_your_writes():
+	'''
+	Return _ReadYourWritesCtx object that can be used by 'with' statement, e.g.
+	for a request. Outside the context a write makes all later select of the
+	thread go to the primary.
+
+	with db.read_your_writes():
+		Blog.get(id)    # replica
+		blog.update()   # primary
+		Blog.get(id)    # primary, sees the update
+	'''
+	return _ReadYourWritesCtx()
+
+
+class _PrimaryCtx(object):
+	'''
+	_PrimaryCtx object that sends all select of current thread to the primary,
+	without query cache, until the most outer context exits.
+	'''
+	def __enter__(self):
+		global _db_ctx
+		_db_ctx.primary = _db_ctx.primary + 1
+		return self
+
+	def __exit__(self, exctype, excvalue, traceback):
+		global _db_ctx
+		_db_ctx.primary = _db_ctx.primary - 1
+
+
+def primary():
+	'''
+	Return _PrimaryCtx object that can be used by 'with' statement, for reads that
+	must see the current state of the primary, e.g. indexes and progress of DDL
+	which replicas may not have applied yet.
+
+	with db.primary():
+		db.select('show index from `blogs`')    # primary
+	'''
+	return _PrimaryCtx()
+
+
+def in_transaction():
+	'''
+	Return True if current thread is in a transaction.
+	'''
+	return _db_ctx.transactions > 0
+
+
+def get_identity_map():
+	'''
+	Return identity map (dict) of current thread, or None if not enabled.
+	'''
+	return _db_ctx.identity_map
+
+
+def _call_after_commit(fn):
+	# the data is committed, a failed callback must not fail the caller:
+	try:
+		fn()
+	except Exception:
+		logging.exception('after commit callback failed.')
+
+
+def after_commit(fn):
+	'''
+	Call fn() after the most outer transaction of current thread commits, or now
+	if not in transaction. It is not called if the transaction (or the nested
+	transaction where it is registered) rolls back. Used for side effects like
+	invalidating caches, which must not see uncommitted data.
+
+	>>> L = []
+	>>> with transaction():
+	... 	after_commit(lambda: L.append(1))
+	... 	try:
+	... 		with transaction():
+	... 			after_commit(lambda: L.append(2))
+	... 			raise StandardError('rollback nested transaction')
+	... 	except StandardError:
+	... 		pass
+	... 	L.append(0)
+	>>> L
+	[0, 1]
+	'''
+	if _db_ctx.transactions > 0:
+		_db_ctx.after_commit.append(fn)
+	else:
+		_call_after_commit(fn)
+
+
+def _clear_identity_map():
+	# objects in the map may hold changes which are rolled back:
+	if _db_ctx.identity_map:
+		_db_ctx.identity_map.clear()
+
+
+def _execute(sql):
+	'''
+	Execute a statement on current connection without commit, e.g. savepoint.
+	'''
+	cursor = _db_ctx.connection.cursor()
+	try:
+		cursor.execute(sql)
+	finally:
+		cursor.close()
+
+
 class _TransactionCtx(object):
 	'''
-	_TransactionCtx object that can handle transactions.
+	_TransactionCtx object that can handle transactions. A nested transaction is
+	a savepoint of the outer one: if it fails, only its changes are rolled back.
 
 	with _TransactionCtx():
 		pass
@@ -228,7 +510,22 @@ class _TransactionCtx(object):
 			_db_ctx.init()
 			self.should_close_conn = True
 		_db_ctx.transactions = _db_ctx.transactions + 1
-		logging.info('begin transaction...' if _db_ctx.transactions==1 else 'join current transaction...')
+		self.savepoint = None
+		if _db_ctx.transactions==1:
+			logging.info('begin transaction...')
+			del _db_ctx.after_commit[:]
+			_db_ctx.doomed = None
+		else:
+			self.savepoint = 'sp_%d' % _db_ctx.transactions
+			self.callbacks = len(_db_ctx.after_commit)
+			logging.info('begin nested transaction %s...' % self.savepoint)
+			try:
+				if _db_ctx.doomed:
+					raise _doomed_error()
+				_execute('savepoint %s' % self.savepoint)
+			except:
+				_db_ctx.transactions = _db_ctx.transactions - 1
+				raise
 		return self
 
 	def __exit__(self, exctype, excvalue, traceback):
@@ -240,29 +537,73 @@ class _TransactionCtx(object):
 					self.commit()
 				else:
 					self.rollback()
+			elif exctype is None:
+				_execute('release savepoint %s' % self.savepoint)
+			else:
+				self.rollback_savepoint(excvalue)
 		finally:
 			if self.should_close_conn:
 				_db_ctx.cleanup()
 
+	def rollback_savepoint(self, error=None):
+		logging.warning('rollback nested transaction %s...' % self.savepoint)
+		_clear_identity_map()
+		del _db_ctx.after_commit[self.callbacks:]
+		try:
+			_execute('rollback to savepoint %s' % self.savepoint)
+			profiler.incr('transaction.savepoint_rollbacks')
+		except Exception:
+			# e.g. the whole transaction is already rolled back by a deadlock, keep
+			# the original error raised, and the outer transaction can only roll back:
+			logging.exception('rollback nested transaction %s failed.' % self.savepoint)
+			_db_ctx.doomed = error or DBError('rollback to savepoint %s failed' % self.savepoint)
+			profiler.incr('transaction.doomed')
+
 	def commit(self):
 		global _db_ctx
+		if _db_ctx.doomed:
+			# statements before the failed nested transaction are lost:
+			e = _doomed_error()
+			self.rollback()
+			raise e
 		logging.info('commit transaction...')
+		start = time.time()
 		try:
 			_db_ctx.connection.commit()
+			profiler.record('commit', time.time() - start)
 			logging.info('commit ok.')
 		except:
 			logging.warning('commit failed. try rollback...')
 			_db_ctx.connection.rollback()
 			logging.warning('rollback ok.')
 			raise
+		finally:
+			# results cached by other threads before commit are stale now:
+			query_cache.bump(_db_ctx.written_tables)
+			_db_ctx.written_tables.clear()
+			callbacks = _db_ctx.after_commit[:]
+			del _db_ctx.after_commit[:]
+		for fn in callbacks:
+			_call_after_commit(fn)
 
 	def rollback(self):
 		global _db_ctx
 		logging.warning('rollback transaction...')
+		_db_ctx.written_tables.clear()
+		del _db_ctx.after_commit[:]
+		_db_ctx.doomed = None
+		_clear_identity_map()
 		_db_ctx.connection.rollback()
 		logging.warning('rollback ok.')
 
 
+def _doomed_error():
+	# same errno, so with_transaction() retries a deadlock:
+	e = DBError('transaction is rolled back by error in nested transaction: %s' % _db_ctx.doomed)
+	e.errno = getattr(_db_ctx.doomed, 'errno', None)
+	return e
+
+
 def transaction():
 	'''
 	Create a transaction object so can use 'with' statement.
@@ -284,13 +625,50 @@ def transaction():
 	StandardError: will cause rollback...
 	>>> select('select * from user where id=?', 900302)
 	[]
+	>>> with transaction():
+	... 	update_profile(900303, 'Go', False)
+	... 	try:
+	... 		with transaction():
+	... 			update_profile(900304, 'Perl', True)
+	... 	except StandardError:
+	... 		pass
+	>>> [u.name for u in select('select * from user where id in (?, ?)', 900303, 900304)]
+	[u'Go']
+
+	If the nested transaction cannot roll back to its savepoint, e.g. a deadlock
+	rolled back the whole transaction, the outer one cannot commit:
+
+	>>> with transaction():
+	... 	update_profile(900305, 'Lua', False)
+	... 	try:
+	... 		with transaction():
+	... 			_execute('release savepoint sp_2')
+	... 			update_profile(900306, 'Tcl', True)
+	... 	except StandardError:
+	... 		pass
+	Traceback (most recent call last):
+		...
+	DBError: transaction is rolled back by error in nested transaction: will cause rollback...
+	>>> select('select * from user where id in (?, ?)', 900305, 900306)
+	[]
 	'''
 	return _TransactionCtx()
 
 
-def with_transaction(func):
+# errors of InnoDB that can succeed if the transaction is retried:
+_ER_LOCK_WAIT_TIMEOUT = 1205
+_ER_LOCK_DEADLOCK = 1213
+
+def _is_retryable(e):
+	return getattr(e, 'errno', None) in (_ER_LOCK_DEADLOCK, _ER_LOCK_WAIT_TIMEOUT)
+
+
+def with_transaction(func=None, retries=0, backoff=0.05):
 	'''
-	Decorator that makes function around transaction.
+	Decorator that makes function around transaction. With retries, the function
+	is called again after a deadlock or lock wait timeout, sleeping backoff seconds
+	doubled for each retry with random jitter. Retries only happen for the most
+	outer transaction, because the error rolls back the whole transaction.
 
 	>>> @with_transaction
 	... def update_profile(id, name, rollback):
@@ -308,16 +686,271 @@ def with_transaction(func):
 	StandardError: will cause rollback...
 	>>> select('select * from user where id=?', 9090)
 	[]
+	>>> class Deadlock(StandardError):
+	... 	errno = 1213
+	>>> calls = []
+	>>> @with_transaction(retries=2, backoff=0.001)
+	... def conflict():
+	... 	calls.append(1)
+	... 	if len(calls) < 3:
+	... 		raise Deadlock()
+	>>> conflict()
+	>>> len(calls)
+	3
 	'''
+	if func is None:
+		return lambda f: with_transaction(f, retries, backoff)
 	@functools.wraps(func)
 	def _wrapper(*args, **kw):
 		_start = time.time()
-		with _TransactionCtx():
-			return func(*args, **kw)
-		_profiling(_start)
+		nested = _db_ctx.transactions > 0
+		attempt = 0
+		try:
+			while True:
+				try:
+					with _TransactionCtx():
+						return func(*args, **kw)
+				except Exception, e:
+					if nested or not _is_retryable(e):
+						raise
+					profiler.incr('transaction.lock_errors')
+					if attempt >= retries:
+						if retries:
+							profiler.incr('transaction.retries_exhausted')
+						raise
+					attempt = attempt + 1
+					delay = backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+					logging.warning('transaction of %s() failed: %s, retry %d/%d in %.3f s...' % (func.__name__, e, attempt, retries, delay))
+					profiler.incr('transaction.retries')
+					time.sleep(delay)
+		finally:
+			_profiling(_start, 'transaction of %s()' % func.__name__)
 	return _wrapper
 
 
+# -------------------query cache-------------------------
+
+_RE_TABLES = re.compile(r'\b(?:from|join|update|into)\s+(`?\w+`?(?:\s*,\s*`?\w+`?)*)', re.IGNORECASE)
+
+def _parse_tables(sql):
+	'''
+	Return sorted table names in SQL.
+
+	>>> _parse_tables('select * from `blogs` b join users u on b.user_id=u.id where b.id in (select blog_id from comments)')
+	['blogs', 'comments', 'users']
+	>>> _parse_tables('insert into `user` (`id`) values (?)')
+	['user']
+	>>> _parse_tables('select count(*) from a, `b` where x=?')
+	['a', 'b']
+	'''
+	return sorted(set(t.strip(' `') for m in _RE_TABLES.findall(sql) for t in m.split(',')))
+
+
+def _sizeof(value):
+	'''
+	Estimate memory used by result.
+	'''
+	if isinstance(value, list):
+		return sys.getsizeof(value) + sum(_sizeof(x) for x in value)
+	if isinstance(value, dict):
+		return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value.itervalues())
+	return sys.getsizeof(value)
+
+
+def _copy(value):
+	if isinstance(value, list):
+		return [Dict(d.iterkeys(), d.itervalues()) for d in value]
+	if isinstance(value, Dict):
+		return Dict(value.iterkeys(), value.itervalues())
+	return value
+
+
+class _QueryCache(object):
+	'''
+	Cache of select results in current process. A result remembers the versions of
+	the tables in SQL, and becomes invalid once any of the tables is written by
+	_update() in current process. Writes by other processes are seen after ttl.
+	Results are evicted in LRU order if the estimated memory exceeds max_bytes.
+
+	>>> c = _QueryCache(max_bytes=1000)
+	>>> versions = c.versions(['user'])
+	>>> c.set(('select * from user', ()), ['user'], versions, [Dict(id=1)], 60)
+	>>> c.get(('select * from user', ()), ['user'])
+	[{'id': 1}]
+	>>> c.bump(['user'])
+	>>> c.get(('select * from user', ()), ['user']) is _MISS
+	True
+	>>> c.set('big', [], c.versions([]), 'x' * 2000, 60)
+	>>> c.get('big', []) is _MISS
+	True
+	>>> c.stats()['hits'], c.stats()['misses']
+	(1, 2)
+	'''
+	def __init__(self, max_bytes=32 * 1024 * 1024):
+		self.max_bytes = max_bytes
+		self._bytes = 0
+		self._data = OrderedDict() # key => (expires, versions, size, value)
+		self._versions = {} # table => version
+		self._written_at = {} # table => time of last bump
+		self._lock = threading.Lock()
+		self._hits = 0
+		self._misses = 0
+
+	def versions(self, tables):
+		return tuple(self._versions.get(t, 0) for t in tables)
+
+	def bump(self, tables):
+		now = time.time()
+		with self._lock:
+			for t in tables:
+				self._versions[t] = self._versions.get(t, 0) + 1
+				self._written_at[t] = now
+
+	def written_within(self, tables, seconds):
+		'''
+		Return True if any of tables is written in current process within seconds.
+		'''
+		since = time.time() - seconds
+		return any(self._written_at.get(t, 0) > since for t in tables)
+
+	def get(self, key, tables):
+		with self._lock:
+			entry = self._data.pop(key, None)
+			if entry is not None:
+				expires, versions, size, value = entry
+				if expires > time.time() and versions == self.versions(tables):
+					# move to the end as the most recently used:
+					self._data[key] = entry
+					self._hits = self._hits + 1
+					return value
+				self._bytes = self._bytes - size
+			self._misses = self._misses + 1
+			return _MISS
+
+	def set(self, key, tables, versions, value, ttl):
+		'''
+		Store value with the versions of tables taken before the query, so a write
+		during the query makes it invalid.
+		'''
+		size = _sizeof(value)
+		with self._lock:
+			old = self._data.pop(key, None)
+			if old is not None:
+				self._bytes = self._bytes - old[2]
+			if size <= self.max_bytes:
+				self._data[key] = (time.time() + ttl, versions, size, value)
+				self._bytes = self._bytes + size
+			while self._bytes > self.max_bytes:
+				k, entry = self._data.popitem(last=False)
+				self._bytes = self._bytes - entry[2]
+
+	def stats(self):
+		return dict(hits=self._hits, misses=self._misses, entries=len(self._data), bytes=self._bytes, max_bytes=self.max_bytes)
+
+
+_MISS = object()
+
+# global query cache, set query_cache.max_bytes to change the memory bound:
+query_cache = _QueryCache()
+
+
+def _cached_select(sql, first, args, ttl):
+	'''
+	Select with query cache if ttl > 0. Inside a transaction or primary() context
+	the cache is not used, so uncommitted or latest changes are always seen.
+	'''
+	if not ttl or _db_ctx.transactions > 0 or _db_ctx.primary:
+		return _select(sql, first, *args)
+	tables = _parse_tables(sql)
+	key = (sql, first, args)
+	try:
+		value = query_cache.get(key, tables)
+	except TypeError:
+		# args are not hashable:
+		return _select(sql, first, *args)
+	if value is _MISS:
+		versions = query_cache.versions(tables)
+		value = _select(sql, first, *args)
+		if cacheable(tables):
+			query_cache.set(key, tables, versions, value, ttl)
+	return _copy(value)
+
+
+def cacheable(tables):
+	'''
+	Return False if the last select of current thread is read from a replica and
+	any of tables is written in current process within max_replica_lag seconds:
+	the replica may not have the write yet, and the result must not be cached
+	under the new table version or after the row is evicted.
+	'''
+	return not (_db_ctx.replica_read and query_cache.written_within(tables, max_replica_lag))
+
+
+# -------------------slow query--------------------------
+
+# set 'json' to use EXPLAIN FORMAT=JSON (MySQL 5.6+):
+explain_format = ''
+
+# explain slow statements of the same fingerprint at most once in this many seconds:
+_EXPLAIN_INTERVAL = 60
+
+_RE_EXPLAINABLE = re.compile(r'^\s*(select|insert|update|delete|replace)\b', re.IGNORECASE)
+
+_explained = {} # fingerprint => last explain time
+
+def _explain(query, args):
+	'''
+	Run EXPLAIN on a side connection, so the connection and transaction of current
+	thread are not touched.
+	'''
+	connection = engine.connect()
+	cursor = None
+	try:
+		cursor = connection.cursor()
+		cursor.execute('EXPLAIN %s%s' % ('FORMAT=JSON ' if explain_format=='json' else '', query), args)
+		names = [x[0] for x in cursor.description]
+		# keep plan JSON serializable:
+		L = [Dict(names, [v if v is None or isinstance(v, (int, long, float, basestring)) else str(v) for v in x]) for x in cursor.fetchall()]
+		if explain_format=='json' and L:
+			return json.loads(L[0].values()[0])
+		return L
+	finally:
+		if cursor:
+			cursor.close()
+		connection.close()
+
+
+def _capture_slow(sql, query, args, elapsed):
+	'''
+	Explain slow statement in background and store it to profiler.slow_queries().
+	'''
+	fp = profiler.fingerprint(sql)
+	now = time.time()
+	if not _RE_EXPLAINABLE.match(sql) or now - _explained.get(fp, 0) < _EXPLAIN_INTERVAL:
+		return
+	if len(_explained) > 1000:
+		_explained.clear()
+	_explained[fp] = now
+	entry = dict(time=now, sql=sql, fingerprint=fp, args_fingerprint=hashlib.md5(repr(args)).hexdigest()[:12], duration=elapsed, call_site=profiler.call_site())
+	def _run():
+		try:
+			entry['plan'] = _explain(query, args)
+		except Exception, e:
+			entry['plan'] = None
+			entry['error'] = str(e)
+		profiler.record_slow(entry)
+	t = threading.Thread(target=_run)
+	t.daemon = True
+	t.start()
+
+
+def _record(sql, query, args, start, rows):
+	elapsed = time.time() - start
+	profiler.record(sql, elapsed, rows)
+	if elapsed > profiler.slow_seconds:
+		_capture_slow(sql, query, args, elapsed)
+
+
 # -------------------SQL func----------------------------
 def _select(sql, first, *args):
 	'''
@@ -325,30 +958,58 @@ def _select(sql, first, *args):
 	'''
 	global _db_ctx
 	cursor = None
-	sql = sql.replace('?', '%s')
-	logging.info('SQL: %s, ARGS: %s' % (sql, args))
+	query = sql.replace('?', '%s')
+	logging.info('SQL: %s, ARGS: %s' % (query, args))
+	start = time.time()
+	connection = _read_connection()
 	try:
-		cursor = _db_ctx.connection.cursor()
-		cursor.execute(sql, args)
+		try:
+			cursor = connection.cursor()
+			cursor.execute(query, args)
+			_db_ctx.replica_read = connection is not _db_ctx.connection
+		except Exception, e:
+			if connection is _db_ctx.connection or not _is_connection_error(e):
+				raise
+			logging.warning('select on replica %s failed, retry on primary: %s' % (connection.replica.name, e))
+			connection.replica.down_until = time.time() + _REPLICA_RETRY_SECONDS
+			if cursor:
+				try:
+					cursor.close()
+				except Exception:
+					pass
+				cursor = None
+			try:
+				_db_ctx.replica.cleanup()
+			except Exception:
+				# the connection is already broken:
+				pass
+			_db_ctx.replica = None
+			cursor = _db_ctx.connection.cursor()
+			cursor.execute(query, args)
+			_db_ctx.replica_read = False
 		if cursor.description:
 			names = [x[0] for x in cursor.description]
 		if first:
 			values = cursor.fetchone()
+			_record(sql, query, args, start, 1 if values else 0)
 			if not values:
 				return None
 			return Dict(names, values)
-		return [Dict(names, x) for x in cursor.fetchall()]
+		L = [Dict(names, x) for x in cursor.fetchall()]
+		_record(sql, query, args, start, len(L))
+		return L
 	finally:
 		if cursor:
 			cursor.close()
 
 
 @with_connection
-def select_one(sql, *args):
+def select_one(sql, *args, **kw):
 	'''
 	Execute select SQL and expected one result.
 	If no result found, return None.
 	If multiple results found, return the first one.
+	Pass cache=ttl to cache the result, see select().
 
 	>>> u1 = dict(id=100, name='Alice', email='alice@test.org', passwd='ABC-12345', last_modified=time.time())
 	>>> u2 = dict(id=101, name='Sarah', email='sarah@test.org', passwd='ABC-12345', last_modified=time.time())
@@ -364,13 +1025,14 @@ def select_one(sql, *args):
 	>>> u2.name
 	u'Alice'
 	'''
-	return _select(sql, True, *args)
+	return _cached_select(sql, True, args, kw.get('cache', 0))
 
 
 @with_connection
-def select_int(sql, *args):
+def select_int(sql, *args, **kw):
 	'''
 	Execute select SQL and expected one int and only one int result. 
+	Pass cache=ttl to cache the result, see select().
 
 	>>> n = update('delete from user')
 	>>> u1 = dict(id=96900, name='Ada', email='ada@test.org', passwd='A-12345', last_modified=time.time())
@@ -392,17 +1054,21 @@ def select_int(sql, *args):
 		...
 	MultiColumnsError: Expect only one column.
 	'''
-	d = _select(sql, True, *args)
+	d = _cached_select(sql, True, args, kw.get('cache', 0))
 	if len(d)!=1:
 		raise MultiColumnsError('Expect only one column.')
 	return d.values()[0]
 
 
 @with_connection
-def select(sql, *args):
+def select(sql, *args, **kw):
 	'''
 	Execute select SQL and return list or empty list if no result.
 
+	Pass cache=ttl to cache the result for ttl seconds, keyed on SQL and args. The
+	cached result is invalidated once any table in SQL is written by update() or
+	insert() in current process.
+
 	>>> u1 = dict(id=200, name='Wall.E', email='wall.e@test.org', passwd='back-to-earth', last_modified=time.time())
 	>>> u2 = dict(id=201, name='Eva', email='eva@test.org', passwd='back-to-earth', last_modified=time.time())
 	>>> insert('user', **u1)
@@ -420,24 +1086,37 @@ def select(sql, *args):
 	u'Eva'
 	>>> L[1].name
 	u'Wall.E'
+	>>> select('select name from user where id=?', 201, cache=60)[0].name
+	u'Eva'
+	>>> n = update('update user set name=? where id=?', 'Eve', 201)
+	>>> select('select name from user where id=?', 201, cache=60)[0].name
+	u'Eve'
 	'''
-	return _select(sql, False, *args)
+	return _cached_select(sql, False, args, kw.get('cache', 0))
 
 
 @with_connection
 def _update(sql, *args):
 	global _db_ctx
 	cursor = None
-	sql = sql.replace('?', '%s')
-	logging.info('SQL: %s, ARGS: %s' % (sql, args))
+	query = sql.replace('?', '%s')
+	logging.info('SQL: %s, ARGS: %s' % (query, args))
+	start = time.time()
 	try:
 		cursor = _db_ctx.connection.cursor()
-		cursor.execute(sql, args)
+		cursor.execute(query, args)
 		r = cursor.rowcount
+		_db_ctx.wrote = True
+		_record(sql, query, args, start, r)
+		tables = _parse_tables(sql)
 		if _db_ctx.transactions==0:
 			# no transaction enviroment:
 			logging.info('auto commit')
 			_db_ctx.connection.commit()
+			query_cache.bump(tables)
+		else:
+			# bump versions when the transaction commits:
+			_db_ctx.written_tables.update(tables)
 		return r
 	finally:
 		if cursor:
@@ -464,6 +1143,26 @@ def insert(table, **kw):
 	return _update(sql, *args)
 
 
+def insert_many(table, rows):
+	'''
+	Execute one insert SQL for many rows, all rows must have the same keys.
+
+	>>> rows = [dict(id=4000 + i, name='U%d' % i, email='u%d@test.org' % i, passwd='u', last_modified=time.time()) for i in range(3)]
+	>>> insert_many('user', rows)
+	3
+	>>> select_int('select count(*) from user where id>=? and id<?', 4000, 4003)
+	3
+	>>> insert_many('user', [])
+	0
+	'''
+	if not rows:
+		return 0
+	cols = rows[0].keys()
+	values = '(%s)' % ','.join(['?'] * len(cols))
+	sql = 'insert into %s (%s) values %s' % (table, ','.join(['`%s`' % col for col in cols]), ','.join([values] * len(rows)))
+	return _update(sql, *[r[col] for r in rows for col in cols])
+
+
 def update(sql, *args):
 	r'''
 	Execute update SQL.
@@ -489,6 +1188,181 @@ def update(sql, *args):
 	return _update(sql, *args)
 
 
+# max worker threads of gather() in a process, functions run in the calling thread
+# if all of them are busy:
+gather_workers = 16
+
+# seconds an idle worker waits for work before it exits and closes its connection:
+_GATHER_IDLE_SECONDS = 60.0
+
+_gather_lock = threading.Lock()
+_gather_idle = [] # idle workers
+_gather_all = set() # all workers
+
+class _GatherWorker(threading.Thread):
+	'''
+	Worker thread of gather(), it keeps its lazy connection between tasks.
+	'''
+	def __init__(self):
+		super(_GatherWorker, self).__init__(name='gather-worker')
+		self.daemon = True
+		self.tasks = Queue.Queue()
+
+	def run(self):
+		global _db_ctx
+		_db_ctx.init()
+		while True:
+			try:
+				task = self.tasks.get(timeout=_GATHER_IDLE_SECONDS)
+			except Queue.Empty:
+				with _gather_lock:
+					# not idle if a task is just submitted:
+					if not self in _gather_idle:
+						continue
+					_gather_idle.remove(self)
+					_gather_all.discard(self)
+				task = None
+			if task is None:
+				_db_ctx.cleanup()
+				return
+			try:
+				task()
+			except Exception:
+				logging.exception('gather task failed.')
+			try:
+				# end the read transaction, the next task must not see its snapshot:
+				_db_ctx.connection.rollback()
+				if _db_ctx.replica:
+					_db_ctx.replica.rollback()
+			except Exception:
+				logging.exception('rollback of gather worker failed.')
+				_db_ctx.cleanup()
+				_db_ctx.init()
+			with _gather_lock:
+				_gather_idle.append(self)
+
+
+@atexit.register
+def _stop_gather_workers():
+	# stop workers after their queued tasks, before the interpreter clears module globals:
+	with _gather_lock:
+		workers = list(_gather_all)
+		_gather_all.clear()
+		del _gather_idle[:]
+	for worker in workers:
+		worker.tasks.put(None)
+	for worker in workers:
+		worker.join(1.0)
+
+
+def _submit(task):
+	'''
+	Run task by an idle or new worker, return False if all workers are busy.
+	'''
+	with _gather_lock:
+		if _gather_idle:
+			worker = _gather_idle.pop()
+		elif len(_gather_all) < gather_workers:
+			worker = _GatherWorker()
+			_gather_all.add(worker)
+			worker.start()
+		else:
+			return False
+	worker.tasks.put(task)
+	return True
+
+
+def gather(*fns):
+	'''
+	Run several independent read functions concurrently and return their results
+	as a list in the same order. The functions are run by a bounded pool of worker
+	threads, each on its own lazy connection which is kept between tasks, and by
+	the current thread: it takes the functions not started by a worker yet, so
+	cheap functions like cache hits usually finish without another thread. If all
+	workers are busy, the functions run in the current thread one by one.
+	If any function raises, the first error (in argument order) is re-raised.
+
+	Inside a transaction the functions are called one by one on the current
+	connection, so they can see the uncommitted changes.
+
+	>>> u1 = dict(id=3000, name='Ann', email='ann@test.org', passwd='ann', last_modified=time.time())
+	>>> insert('user', **u1)
+	1
+	>>> gather(lambda: select_int('select count(*) from user where id=?', 3000), lambda: select_one('select * from user where id=?', 3000).name)
+	[1, u'Ann']
+	>>> gather()
+	[]
+	'''
+	global _db_ctx
+	if len(fns) < 2 or _db_ctx.transactions > 0:
+		return [fn() for fn in fns]
+	results = [None] * len(fns)
+	errors = [None] * len(fns)
+	# workers share the identity map, profiler scopes and read routing of current request:
+	objects = _db_ctx.identity_map
+	scopes = profiler.current_scopes()
+	wrote = _db_ctx.wrote
+	sessions = _db_ctx.sessions
+	primary = _db_ctx.primary
+	lock = threading.Lock()
+	# index of the next function to start, and number of functions not finished:
+	state = [0, len(fns)]
+	finished = threading.Event()
+
+	def _claim():
+		with lock:
+			index = state[0]
+			if index >= len(fns):
+				return None
+			state[0] = index + 1
+			return index
+
+	def _call(index):
+		try:
+			with _ConnectionCtx():
+				results[index] = fns[index]()
+		except BaseException:
+			errors[index] = sys.exc_info()
+		with lock:
+			state[1] = state[1] - 1
+			if state[1] == 0:
+				finished.set()
+
+	def _work():
+		index = _claim()
+		if index is None:
+			# all started by other threads:
+			return
+		_db_ctx.identity_map = objects
+		_db_ctx.wrote = wrote
+		# a read_your_writes() context inside fn must not reset wrote:
+		_db_ctx.sessions = sessions
+		_db_ctx.primary = primary
+		profiler.bind_scopes(scopes)
+		try:
+			_call(index)
+		finally:
+			_db_ctx.identity_map = None
+			_db_ctx.wrote = False
+			_db_ctx.sessions = 0
+			_db_ctx.primary = 0
+			profiler.bind_scopes(())
+
+	for i in xrange(len(fns) - 1):
+		if not _submit(_work):
+			break
+	while True:
+		index = _claim()
+		if index is None:
+			break
+		_call(index)
+	finished.wait()
+	for e in errors:
+		if e:
+			raise e[0], e[1], e[2]
+	return results
+
+
 if __name__ == '__main__':
 	logging.basicConfig(level=logging.DEBUG)
 	create_engine('www-data', 'www-data', 'test')
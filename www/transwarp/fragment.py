@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Jinja2 extension for caching rendered template fragments:
+
+	{% cache 'comments:' ~ blog.id, 300, 'blog:' ~ blog.id %}
+		...
+	{% endcache %}
+
+The first argument is the cache key, the second one is ttl in seconds (0 means
+never expires, default to 0) and the others are tags for invalidation.
+'''
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from jinja2.utils import Markup
+
+
+class FragmentCacheExtension(Extension):
+	'''
+	A fragment rendered while its tag is invalidated is not served later:
+
+	>>> from jinja2 import Environment
+	>>> from cache import TaggedCache, LRUCache
+	>>> env = Environment(extensions=[FragmentCacheExtension])
+	>>> env.fragment_cache = TaggedCache(LRUCache())
+	>>> t = env.from_string("{% cache 'k', 0, 'blog:1' %}{{ load() }}{% endcache %}")
+	>>> def write_during_render():
+	... 	env.fragment_cache.invalidate('blog:1')
+	... 	return 'old'
+	>>> t.render(load=write_during_render)
+	u'old'
+	>>> t.render(load=lambda: 'new')
+	u'new'
+	>>> t.render(load=lambda: 'newer')
+	u'new'
+	'''
+
+	tags = set(['cache'])
+
+	def __init__(self, environment):
+		super(FragmentCacheExtension, self).__init__(environment)
+		# a TaggedCache object, None to disable cache:
+		environment.extend(fragment_cache=None)
+
+	def parse(self, parser):
+		lineno = next(parser.stream).lineno
+		args = [parser.parse_expression()]
+		if parser.stream.skip_if('comma'):
+			args.append(parser.parse_expression())
+		else:
+			args.append(nodes.Const(0))
+		tags = []
+		while parser.stream.skip_if('comma'):
+			tags.append(parser.parse_expression())
+		args.append(nodes.List(tags))
+		body = parser.parse_statements(['name:endcache'], drop_needle=True)
+		return nodes.CallBlock(self.call_method('_cache_support', args), [], [], body).set_lineno(lineno)
+
+	def _cache_support(self, key, ttl, tags, caller):
+		cache = self.environment.fragment_cache
+		if cache is None:
+			return caller()
+		key = 'fragment:%s' % key
+		r = cache.get(key)
+		if r is None:
+			# versions before rendering, a write committed while rendering makes the result stale:
+			versions = cache.versions(tags)
+			r = caller()
+			cache.set(key, r, ttl, versions=versions)
+		# keep it safe from autoescape after loaded from cache:
+		return Markup(r)
+
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
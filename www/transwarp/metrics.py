@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Request metrics in Prometheus text format. The web module calls begin() for
+each request and finish() with the response body.
+
+For each route and method, it counts requests by status, and keeps histograms
+of handler time, render time, db time and response size:
+
+	handler time: from the request starts until the handler (with interceptors) returns.
+	render time: rendering the template, and producing the body if it is streamed.
+	db time: time of statements recorded by profiler during the request.
+
+Requests in flight are counted until the body is closed, so streamed responses
+like event streams are counted while they are open.
+
+Other values like queue lengths are added by gauge(name, help, fn). Counters of
+profiler.incr() are exported as events_total{name="..."}. Get all of them by
+render().
+'''
+
+import time, bisect, logging, threading
+
+import profiler
+
+# set by configuration:
+enabled = True
+
+_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+_SIZE_BUCKETS = (512, 2048, 8192, 32768, 131072, 524288, 2097152, float('inf'))
+
+# routes beyond this number are counted as '(others)':
+_MAX_ROUTES = 500
+
+class _Histogram(object):
+	'''
+	>>> h = _Histogram((1, 10, float('inf')))
+	>>> for v in (0.5, 1, 5, 50):
+	... 	h.add(v)
+	>>> h.counts, h.sum
+	([2, 1, 1], 56.5)
+	'''
+	__slots__ = ('buckets', 'counts', 'sum')
+
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * len(buckets)
+		self.sum = 0.0
+
+	def add(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum = self.sum + value
+
+
+class _RouteStat(object):
+
+	def __init__(self):
+		self.statuses = {} # status code => count
+		self.handler = _Histogram(_TIME_BUCKETS)
+		self.render = _Histogram(_TIME_BUCKETS)
+		self.db = _Histogram(_TIME_BUCKETS)
+		self.size = _Histogram(_SIZE_BUCKETS)
+
+
+_lock = threading.Lock()
+_routes = {} # (method, route) => _RouteStat
+_in_flight = [0]
+_gauges = [] # (name, help, fn)
+
+
+_bisect = bisect.bisect_left
+
+def _add(h, value):
+	# same as h.add(value), inlined for the request path:
+	h.counts[_bisect(h.buckets, value)] += 1
+	h.sum = h.sum + value
+
+
+class _Request(object):
+	'''
+	Timing of a request, returned by begin().
+	'''
+	__slots__ = ('start', 'handler', 'render', 'status', 'route', '_mark', '_scope')
+
+	def __init__(self):
+		self.start = time.time()
+		self.handler = 0.0
+		self.render = 0.0
+		self.status = '500'
+		# set by web module once the route is matched:
+		self.route = None
+		self._mark = self.start
+		self._scope = profiler._Scope()
+		self._scope.__enter__()
+
+	def handled(self):
+		now = time.time()
+		self.handler = now - self.start
+		self._mark = now
+
+	def rendered(self):
+		self.render = self.render + time.time() - self._mark
+
+	def start_response(self, start_response):
+		'''
+		Return start_response that keeps the status code.
+		'''
+		def _start_response(status, headers, *args):
+			self.status = status[:3]
+			return start_response(status, headers, *args)
+		return _start_response
+
+	def finish(self, method, route, body):
+		'''
+		Return the body. If the body is an iterator, it is wrapped to measure
+		the time of producing it, and the request is recorded when it is closed.
+		'''
+		# the body may be iterated in another thread, queries there are added by _Body:
+		self._scope.__exit__(None, None, None)
+		if isinstance(body, str):
+			self._record(method, route, len(body))
+			return body
+		if isinstance(body, (list, tuple)):
+			self._record(method, route, sum(map(len, body)))
+			return body
+		return _Body(self, method, route, body)
+
+	def _record(self, method, route, size):
+		key = (method, route or '(unmatched)')
+		with _lock:
+			_in_flight[0] = _in_flight[0] - 1
+			stat = _routes.get(key)
+			if stat is None:
+				if len(_routes) >= _MAX_ROUTES:
+					key = (method, '(others)')
+				stat = _routes.setdefault(key, _RouteStat())
+			stat.statuses[self.status] = stat.statuses.get(self.status, 0) + 1
+			_add(stat.handler, self.handler)
+			_add(stat.render, self.render)
+			_add(stat.db, self._scope.elapsed)
+			_add(stat.size, size)
+
+
+class _Body(object):
+
+	def __init__(self, request, method, route, body):
+		self._request = request
+		self._method = method
+		self._route = route
+		self._body = body
+		self._it = iter(body)
+		self._size = 0
+		self._closed = False
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		request = self._request
+		request._mark = time.time()
+		request._scope.__enter__()
+		try:
+			s = self._it.next()
+		finally:
+			request._scope.__exit__(None, None, None)
+			request.rendered()
+		self._size = self._size + len(s)
+		return s
+
+	def close(self):
+		if self._closed:
+			return
+		self._closed = True
+		try:
+			if hasattr(self._body, 'close'):
+				self._body.close()
+		finally:
+			self._request._record(self._method, self._route, self._size)
+
+
+def begin():
+	'''
+	Start timing a request.
+
+	>>> r = begin()
+	>>> profiler.record('select * from user', 0.002)
+	>>> r.handled()
+	>>> r.start_response(lambda status, headers: None)('404 Not Found', [])
+	>>> r.finish('GET', None, ['<html>', '</html>'])
+	['<html>', '</html>']
+	>>> r = begin()
+	>>> r.handled()
+	>>> r.status = '200'
+	>>> body = r.finish('GET', '/blog/:blog_id', iter(['<html>', '</html>']))
+	>>> _in_flight[0]
+	1
+	>>> ''.join(body)
+	'<html></html>'
+	>>> body.close()
+	>>> _in_flight[0]
+	0
+	>>> [(k, v.statuses, v.size.sum, v.db.sum) for k, v in sorted(_routes.iteritems())]
+	[(('GET', '(unmatched)'), {'404': 1}, 13.0, 0.002), (('GET', '/blog/:blog_id'), {'200': 1}, 13.0, 0.0)]
+	>>> reset()
+	>>> profiler.reset()
+	'''
+	r = _Request()
+	with _lock:
+		_in_flight[0] = _in_flight[0] + 1
+	return r
+
+
+def gauge(name, help, fn):
+	'''
+	Export the return value of fn() as a gauge. The gauge is skipped if fn()
+	raises an error.
+	'''
+	_gauges.append((name, help, fn))
+
+
+def _escape(s):
+	return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_bound(b):
+	if b == float('inf'):
+		return '+Inf'
+	return repr(b) if isinstance(b, float) else str(b)
+
+
+def _histogram_lines(L, name, labels, h):
+	n = 0
+	for b, count in zip(h.buckets, h.counts):
+		n = n + count
+		L.append('%s_bucket{%s,le="%s"} %d' % (name, labels, _format_bound(b), n))
+	L.append('%s_sum{%s} %r' % (name, labels, h.sum))
+	L.append('%s_count{%s} %d' % (name, labels, n))
+
+
+def render():
+	'''
+	Return all metrics in Prometheus text format.
+
+	>>> r = begin()
+	>>> r.handled()
+	>>> r.status = '200'
+	>>> r.finish('GET', '/', 'hello')
+	'hello'
+	>>> gauge('test_value', 'A test value.', lambda: 3)
+	>>> gauge('test_error', 'A broken value.', lambda: 1 / 0)
+	>>> s = render()
+	>>> 'http_requests_total{method="GET",route="/",status="200"} 1' in s
+	True
+	>>> 'http_handler_seconds_bucket{method="GET",route="/",le="+Inf"} 1' in s
+	True
+	>>> 'http_response_bytes_sum{method="GET",route="/"} 5.0' in s, 'test_value 3' in s
+	(True, True)
+	>>> 'test_error' in s
+	False
+	>>> del _gauges[:]
+	>>> reset()
+	'''
+	with _lock:
+		# copy everything, they are changed by other requests once the lock is released:
+		stats = [(k, dict(s.statuses), _copy(s.handler), _copy(s.render), _copy(s.db), _copy(s.size)) for k, s in sorted(_routes.iteritems())]
+		in_flight = _in_flight[0]
+	L = []
+	L.append('# HELP http_requests_total Requests by route, method and status.')
+	L.append('# TYPE http_requests_total counter')
+	for (method, route), statuses, handler, render, db, size in stats:
+		for status, n in sorted(statuses.iteritems()):
+			L.append('http_requests_total{method="%s",route="%s",status="%s"} %d' % (_escape(method), _escape(route), status, n))
+	for i, name, help in ((2, 'http_handler_seconds', 'Time of handler and interceptors.'), (3, 'http_render_seconds', 'Time of rendering template and producing streamed body.'), (4, 'http_db_seconds', 'Time of database statements in request.'), (5, 'http_response_bytes', 'Size of response body.')):
+		L.append('# HELP %s %s' % (name, help))
+		L.append('# TYPE %s histogram' % name)
+		for s in stats:
+			method, route = s[0]
+			_histogram_lines(L, name, 'method="%s",route="%s"' % (_escape(method), _escape(route)), s[i])
+	L.append('# HELP http_requests_in_flight Requests not finished, including open streams.')
+	L.append('# TYPE http_requests_in_flight gauge')
+	L.append('http_requests_in_flight %d' % in_flight)
+	for name, help, fn in _gauges:
+		try:
+			value = fn()
+		except Exception:
+			logging.exception('failed to get gauge %s.' % name)
+			continue
+		L.append('# HELP %s %s' % (name, help))
+		L.append('# TYPE %s gauge' % name)
+		L.append('%s %s' % (name, value))
+	L.append('# HELP events_total Events counted by profiler.incr().')
+	L.append('# TYPE events_total counter')
+	for name, n in sorted(profiler.counters().iteritems()):
+		L.append('events_total{name="%s"} %d' % (_escape(name), n))
+	L.append('')
+	return '\n'.join(L)
+
+
+def _copy(h):
+	c = _Histogram(h.buckets)
+	c.counts = list(h.counts)
+	c.sum = h.sum
+	return c
+
+
+def reset():
+	with _lock:
+		_routes.clear()
+
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
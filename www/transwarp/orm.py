@@ -8,8 +8,8 @@ Database operation module. This module is independent with web module
 ORM:把关系数据库的一行映射为一个对象，也就是一个类对应一个表，这样，写代码更简单，不用直接操作SQL语句
 '''
 
-import time, logging
-import db
+import re, time, logging
+import db, cache
 
 class Field(object):
 
@@ -23,6 +23,8 @@ class Field(object):
 		self.updatable = kw.get('updatable', True)
 		self.insertable = kw.get('insertable', True)
 		self.ddl = kw.get('ddl', '')
+		self.index = kw.get('index', False)
+		self.unique = kw.get('unique', False)
 		self._order = Field._count
 		Field._count = Field._count + 1
 
@@ -98,9 +100,26 @@ class VersionField(Field):
 	def __init__(self, name=None):
 		super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
 
-_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
+_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete', 'post_insert', 'post_update', 'post_delete'])
 		
-def _gen_sql(table_name, mappings):
+def _gen_indexes(name, mappings, indexes):
+	'''
+	Return list of (index name, columns, unique) from fields with index=True or
+	unique=True and composite indexes of __indexes__.
+	'''
+	L = []
+	for f in sorted(mappings.values(), lambda x, y: cmp(x._order, y._order)):
+		if (f.index or f.unique) and not f.primary_key:
+			L.append(('idx_%s' % f.name, (f.name,), f.unique))
+	columns = set(f.name for f in mappings.itervalues())
+	for cols in indexes:
+		for c in cols:
+			if not c in columns:
+				raise TypeError('Invalid column \'%s\' of index in class: %s' % (c, name))
+		L.append(('idx_%s' % '_'.join(cols), tuple(cols), False))
+	return L
+
+def _gen_sql(table_name, mappings, indexes=()):
 	pk = None
 	sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
 	for f in sorted(mappings.values(), lambda x, y: cmp(x._order, y._order)):
@@ -111,10 +130,18 @@ def _gen_sql(table_name, mappings):
 		if f.primary_key:
 			pk = f.name
 		sql.append(nullable and '  `%s` %s,' % (f.name, ddl) or '  `%s` %s not null,' % (f.name, ddl))
+	for index_name, cols, unique in indexes:
+		sql.append('  %skey `%s` (%s),' % (unique and 'unique ' or '', index_name, ', '.join('`%s`' % c for c in cols)))
 	sql.append('  primary key(`%s`)' % pk)
 	sql.append(');')
 	return '\n'.join(sql)
 
+# model classes with __cache__:
+_cached_models = []
+
+# where clause that only matches primary key, like "where id=?" or "where `id` = ?":
+_RE_PK_WHERE = re.compile(r'^\s*where\s+`?(\w+)`?\s*=\s*\?\s*$', re.IGNORECASE)
+
 class ModelMetaclass(type):
 	'''
 	Metaclass for model objects.
@@ -161,10 +188,19 @@ class ModelMetaclass(type):
 			attrs['__table__'] = name.lower()
 		attrs['__mappings__'] = mappings
 		attrs['__primary_key__'] = primary_key
-		attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+		attrs['__table_indexes__'] = _gen_indexes(name, mappings, attrs.get('__indexes__', ()))
+		attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings, attrs['__table_indexes__'])
 		for trigger in _triggers:
 			if not trigger in attrs:
 				attrs[trigger] = None
+		if attrs.get('__cache__'):
+			options = attrs['__cache__']
+			logging.info('Enable cache for class %s: %s' % (name, options))
+			attrs['__cache_backend__'] = options.get('backend') or cache.LRUCache(options.get('max_entries', 1000))
+			attrs['__cache_stats__'] = dict(hits=0, misses=0)
+			model = type.__new__(cls, name, bases, attrs)
+			_cached_models.append(model)
+			return model
 		return type.__new__(cls, name, bases, attrs)
 
 
@@ -176,9 +212,10 @@ class Model(dict):
 	>>> class User(Model):
 	... 	id = IntegerField(primary_key=True)
 	... 	name = StringField()
-	... 	email = StringField(updatable=False)
+	... 	email = StringField(updatable=False, unique=True)
 	... 	passwd = StringField(default=lambda: '******')
-	... 	last_modified = FloatField()
+	... 	last_modified = FloatField(index=True)
+	... 	__indexes__ = [('name', 'last_modified')]
 	... 	def pre_insert(self):
 	... 		self.last_modified = time.time()
 	>>> u = User(id=10190, name='Michael', email='orm@db.org')
@@ -198,6 +235,23 @@ class Model(dict):
 	>>> r = f.update() # change email but email is non-updatable!
 	>>> len(User.find_all())
 	1
+	>>> sorted(User.find_first('where id=?', 10190, fields=['name']).keys())
+	[u'id', u'name']
+	>>> User.find_by('where id=?', 10190, fields=['nickname'])
+	Traceback (most recent call last):
+		...
+	ValueError: Invalid field 'nickname' in class: User
+	>>> m = User.get_many([10190, 10191], fields=['name'])
+	>>> m.keys(), m[10190].name
+	([10190], u'Michael')
+	>>> L = prefetch([dict(user_id=10190), dict(user_id=10191)], 'user_id', User, fields=['email'])
+	>>> [d['user'] and d['user'].email for d in L]
+	[u'orm@db.org', None]
+	>>> with db.identity_map():
+	... 	u1 = User.get(10190)
+	... 	u2 = User.find_first('where id=?', 10190)
+	>>> u1 is u2
+	True
 	>>> g = User.get(10190)
 	>>> g.email
 	u'orm@db.org'
@@ -213,11 +267,26 @@ class Model(dict):
 	  `email` varchar(255) not null,
 	  `passwd` varchar(255) not null,
 	  `last_modified` real not null,
+	  unique key `idx_email` (`email`),
+	  key `idx_last_modified` (`last_modified`),
+	  key `idx_name_last_modified` (`name`, `last_modified`),
 	  primary key(`id`)
 	);
 	'''
 	__metaclass__ = ModelMetaclass
 
+	# set __cache__ = dict(ttl=300, max_entries=1000) in subclass to cache objects
+	# loaded by get(), pass backend=... to use other backend than LRUCache:
+	__cache__ = None
+	__cache_backend__ = None
+
+	# queue of insert(deferred=True), set by set_write_behind():
+	__write_behind__ = None
+
+	# composite indexes as list of column names, e.g. [('blog_id', 'created_at')],
+	# single column index is defined by Field(index=True) or Field(unique=True):
+	__indexes__ = ()
+
 	def __init__(self, **kw):
 		super(Model, self).__init__(**kw)
 
@@ -230,52 +299,207 @@ class Model(dict):
 	def __setattr__(self, key, value):
 		self[key] = value
 
+	@classmethod
+	def _from_identity_map(cls, pk):
+		objects = db.get_identity_map()
+		return objects.get((cls.__table__, pk)) if objects is not None else None
+
+	@classmethod
+	def _load(cls, d, fields=None):
+		'''
+		Make object from a row. If identity map is enabled, a row with all fields
+		returns the object already loaded, or is stored to the map.
+		'''
+		objects = db.get_identity_map()
+		if objects is None or fields:
+			return cls(**d)
+		key = (cls.__table__, d[cls.__primary_key__.name])
+		obj = objects.get(key)
+		if obj is None:
+			obj = objects[key] = cls(**d)
+		return obj
+
+	@classmethod
+	def _cache_key(cls, pk):
+		return 'model:%s:%s' % (cls.__table__, pk)
+
+	@classmethod
+	def _from_cache(cls, pk):
+		backend = cls.__cache_backend__
+		if backend is None:
+			return None
+		d = backend.get(cls._cache_key(pk))
+		if d is None:
+			cls.__cache_stats__['misses'] += 1
+			return None
+		cls.__cache_stats__['hits'] += 1
+		return cls._load(d)
+
+	@classmethod
+	def _to_cache(cls, d):
+		# uncommitted rows must not be seen by other requests:
+		if cls.__cache_backend__ is not None and not db.in_transaction():
+			cls.__cache_backend__.set(cls._cache_key(d[cls.__primary_key__.name]), dict(d), cls.__cache__.get('ttl', 0))
+
+	def _sync(self, written=(), deleted=False):
+		'''
+		Keep identity map and cache consistent after write. The object is written
+		to cache only if the statement wrote all fields, otherwise fields not
+		written (e.g. counters maintained by SQL) may be stale, and the cache is
+		deleted instead.
+
+		A counter changed by SQL between loading and updating the object:
+
+		>>> class Post(Model):
+		... 	__cache__ = dict(ttl=60)
+		... 	id = IntegerField(primary_key=True)
+		... 	title = StringField()
+		... 	comment_count = IntegerField(updatable=False)
+		>>> r = db.update('drop table if exists post')
+		>>> r = db.update('create table post (id int primary key, title text, comment_count int)')
+		>>> p = Post(id=1, title='a', comment_count=0).insert()
+		>>> p = Post.get(1)
+		>>> p.html = '<p>a</p>'
+		>>> r = db.update('update post set comment_count=comment_count+1 where id=?', 1)
+		>>> Post.evict(1)
+		>>> p.title = 'b'
+		>>> p = p.update()
+		>>> p = Post.get(1)
+		>>> p.title, p.comment_count, 'html' in p
+		(u'b', 1, False)
+		>>> r = db.update('drop table post')
+		'''
+		pk = getattr(self, self.__primary_key__.name)
+		# object with partial fields must not be returned by get():
+		complete = not deleted and all(k in self for k in self.__mappings__)
+		objects = db.get_identity_map()
+		if objects is not None:
+			if complete:
+				objects[(self.__table__, pk)] = self
+			else:
+				objects.pop((self.__table__, pk), None)
+		if self.__cache_backend__ is not None:
+			if complete and not db.in_transaction() and all(k in written for k in self.__mappings__):
+				# only mapped fields, attributes added to the object are not cached:
+				self._to_cache(dict((k, self[k]) for k in self.__mappings__))
+			else:
+				self.__cache_backend__.delete(self._cache_key(pk))
+
 	@classmethod
 	def get(cls, pk):
 		'''
-		Get by primary key.
+		Get by primary key. The identity map and cache are checked first if enabled.
 		'''
+		obj = cls._from_identity_map(pk)
+		if obj is None:
+			obj = cls._from_cache(pk)
+		if obj is not None:
+			return obj
 		d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-		return cls(**d) if d else None
+		if d is None:
+			return None
+		if db.cacheable([cls.__table__]):
+			cls._to_cache(d)
+		return cls._load(d)
+
+	@classmethod
+	def get_many(cls, pks, chunk_size=500, **kw):
+		'''
+		Get by a list of primary keys with 'where pk in (...)', one query for every
+		chunk_size keys. Return dict of pk => object, missing ones are not included.
+		Pass fields=['name', ...] to load only the specified fields.
+		'''
+		fields = kw.get('fields')
+		r = {}
+		if not fields:
+			for pk in set(pks):
+				obj = cls._from_identity_map(pk)
+				if obj is None:
+					obj = cls._from_cache(pk)
+				if obj is not None:
+					r[pk] = obj
+		pks = [pk for pk in set(pks) if not pk in r]
+		columns = cls._columns(fields)
+		pk = cls.__primary_key__.name
+		for i in xrange(0, len(pks), chunk_size):
+			chunk = pks[i:i + chunk_size]
+			L = db.select('select %s from `%s` where `%s` in (%s)' % (columns, cls.__table__, pk, ','.join(['?'] * len(chunk))), *chunk)
+			cache = not fields and db.cacheable([cls.__table__])
+			for d in L:
+				if cache:
+					cls._to_cache(d)
+				r[d[pk]] = cls._load(d, fields)
+		return r
+
+	@classmethod
+	def _columns(cls, fields):
+		'''
+		Return columns for select, primary key is always included.
+		'''
+		if not fields:
+			return '*'
+		pk = cls.__primary_key__.name
+		L = ['`%s`' % pk]
+		for f in fields:
+			if not f in cls.__mappings__:
+				raise ValueError('Invalid field \'%s\' in class: %s' % (f, cls.__name__))
+			if f != pk:
+				L.append('`%s`' % f)
+		return ','.join(L)
 
 	@classmethod
-	def find_first(cls, where, *args):
+	def find_first(cls, where, *args, **kw):
 		'''
 		Find by where clause and return one result. If multiple results found,
 		only the first one returned. If no result found, return None.
+		Pass fields=['name', ...] to load only the specified fields.
+		Pass cache=ttl to cache the query result, see db.select().
 		'''
-		d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-		return cls(**d) if d else None
+		fields = kw.get('fields')
+		if not fields and len(args)==1:
+			m = _RE_PK_WHERE.match(where)
+			if m and m.group(1)==cls.__primary_key__.name:
+				return cls.get(args[0])
+		d = db.select_one('select %s from %s %s' % (cls._columns(fields), cls.__table__, where), *args, cache=kw.get('cache', 0))
+		return cls._load(d, fields) if d else None
 
 	@classmethod
-	def find_all(cls, *args):
+	def find_all(cls, *args, **kw):
 		'''
 		Find all and return list.
+		Pass fields=['name', ...] to load only the specified fields.
+		Pass cache=ttl to cache the query result, see db.select().
 		'''
-		L = db.select('select * from `%s`' % cls.__table__)
-		return [cls(**d) for d in L]
+		fields = kw.get('fields')
+		L = db.select('select %s from `%s`' % (cls._columns(fields), cls.__table__), cache=kw.get('cache', 0))
+		return [cls._load(d, fields) for d in L]
 
 	@classmethod
-	def find_by(cls, where, *args):
+	def find_by(cls, where, *args, **kw):
 		'''
 		Find by where clause and return list.
+		Pass fields=['name', ...] to load only the specified fields.
+		Pass cache=ttl to cache the query result, see db.select().
 		'''
-		L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-		return [cls(**d) for d in L]
+		fields = kw.get('fields')
+		L = db.select('select %s from `%s` %s' % (cls._columns(fields), cls.__table__, where), *args, cache=kw.get('cache', 0))
+		return [cls._load(d, fields) for d in L]
 
 	@classmethod
-	def count_all(cls):
+	def count_all(cls, **kw):
 		'''
 		Find by 'select count(pk) from table' and return integer.
+		Pass cache=ttl to cache the query result, see db.select().
 		'''
-		return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+		return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__), cache=kw.get('cache', 0))
 
 	@classmethod
-	def count_by(cls, where, *args):
+	def count_by(cls, where, *args, **kw):
 		'''
 		Find by 'select count(pk) from table where ... ' and return int.
+		Pass cache=ttl to cache the query result, see db.select().
 		'''
-		return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__,where), *args)
+		return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__,where), *args, cache=kw.get('cache', 0))
 
 	def update(self):
 		self.pre_update and self.pre_update()
@@ -292,17 +516,30 @@ class Model(dict):
 				args.append(arg)
 		pk = self.__primary_key__.name
 		args.append(getattr(self,pk))
-		db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+		# post_* triggers run in the same transaction as the write:
+		with db.transaction():
+			db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+			self.post_update and self.post_update()
+		# primary key is not updatable but the row is selected by it:
+		self._sync([k for k, v in self.__mappings__.iteritems() if v.updatable or v is self.__primary_key__])
 		return self
 
 	def delete(self):
 		self.pre_delete and self.pre_delete()
 		pk = self.__primary_key__.name
 		args = (getattr(self, pk), )
-		db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+		with db.transaction():
+			db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+			self.post_delete and self.post_delete()
+		self._sync(deleted=True)
 		return self
 
-	def insert(self):
+	def insert(self, deferred=False):
+		'''
+		Insert the object. If deferred and the class has a write-behind queue, the
+		row is queued and written later by batch, and post_insert is called in the
+		transaction of the batch. It is inserted directly if the queue is full.
+		'''
 		self.pre_insert and self.pre_insert()
 		params = {}
 		for k, v in self.__mappings__.iteritems():
@@ -310,9 +547,89 @@ class Model(dict):
 				if not hasattr(self, k):
 					setattr(self, k, v.default)
 				params[v.name] = getattr(self, k)
-		db.insert('%s' % self.__table__, **params)
+		queue = self.__write_behind__
+		if not (deferred and queue is not None and queue.put(params)):
+			with db.transaction():
+				db.insert('%s' % self.__table__, **params)
+				self.post_insert and self.post_insert()
+		self._sync([k for k, v in self.__mappings__.iteritems() if v.insertable])
 		return self
 
+	@classmethod
+	def evict(cls, pk):
+		'''
+		Remove object of pk from identity map and cache, after the row is changed
+		by SQL instead of update().
+		'''
+		objects = db.get_identity_map()
+		if objects is not None:
+			objects.pop((cls.__table__, pk), None)
+		if cls.__cache_backend__ is not None:
+			cls.__cache_backend__.delete(cls._cache_key(pk))
+
+	@classmethod
+	def pending(cls, **kw):
+		'''
+		Return objects inserted with deferred=True but not written yet, which
+		have the same values of kw, e.g. Comment.pending(blog_id=blog_id).
+		'''
+		queue = cls.__write_behind__
+		if queue is None:
+			return []
+		return [cls(**r) for r in queue.pending() if all(r.get(k)==v for k, v in kw.iteritems())]
+
+def cache_stats():
+	'''
+	Return dict of model name => dict(hits, misses, hit_ratio) for models with __cache__.
+	'''
+	r = {}
+	for model in _cached_models:
+		hits, misses = model.__cache_stats__['hits'], model.__cache_stats__['misses']
+		r[model.__name__] = dict(hits=hits, misses=misses, hit_ratio=float(hits) / (hits + misses) if hits + misses else 0.0)
+	return r
+
+
+def set_cache_backend(backend):
+	'''
+	Replace cache backend of all models with __cache__, e.g. a SocketCache shared by processes.
+	'''
+	for model in _cached_models:
+		model.__cache_backend__ = backend
+
+
+def set_write_behind(model, queue):
+	'''
+	Set writebehind.WriteBehindQueue of model for insert(deferred=True). Each
+	batch is inserted in a transaction with post_insert of its rows.
+	'''
+	def _insert(table, rows):
+		with db.transaction():
+			db.insert_many(table, rows)
+			for r in rows:
+				obj = model(**r)
+				obj.post_insert and obj.post_insert()
+	queue.insert = _insert
+	model.__write_behind__ = queue
+
+
+def prefetch(objs, key, model, name=None, **kw):
+	'''
+	Load related objects of model referenced by attribute key of objs in one query,
+	and attach them to objs as attribute name (default to key without '_id'),
+	None if not found. Objects without the key are skipped. Return objs.
+
+		comments = Comment.find_by('order by created_at desc limit ?', 10)
+		prefetch(comments, 'blog_id', Blog, fields=['name'])
+		comments[0].blog.name
+	'''
+	if name is None:
+		name = key[:-3] if key.endswith('_id') else key
+	related = model.get_many([o[key] for o in objs if key in o], **kw)
+	for o in objs:
+		if key in o:
+			o[name] = related.get(o[key])
+	return objs
+
 
 if __name__ == '__main__':
 	logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Query profiler. This module is independent with web and db module, the db module
+calls record() after each SQL statement is executed.
+
+Statements are grouped by fingerprint, which is the SQL with literals stripped.
+For each fingerprint, count, total time, rows and a latency histogram are kept
+to estimate p50/p95/p99. Get them by snapshot().
+
+Queries in a request are counted by:
+
+	with profiler.request() as p:
+		...
+		p.name = 'GET /blog/:blog_id'
+
+If detect_threshold > 0, a request which repeats the same fingerprint that many
+times (the N+1 pattern) is logged with the call-site stack.
+
+Limit the number of queries of a function by:
+
+	@query_budget(3)
+	def blog(blog_id):
+		...
+
+If exceeded, raise QueryBudgetError when strict is True (development and tests),
+otherwise only log a warning. Pass strict=True/False to override it.
+
+Statements slower than slow_seconds are explained by the db module and kept in
+a ring buffer, get them by slow_queries().
+
+Events like retries of transactions are counted by incr(name).
+'''
+
+import os, re, json, bisect, logging, functools, threading, traceback
+from collections import deque
+
+# set by configuration:
+enabled = True
+slow_seconds = 0.1
+detect_threshold = 0
+strict = False
+
+_RE_STRING = re.compile(r'\'(?:[^\'\\]|\\.)*\'|"(?:[^"\\]|\\.)*"')
+_RE_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_RE_ROWS = re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+')
+_RE_SPACES = re.compile(r'\s+')
+
+def fingerprint(sql):
+	'''
+	Return SQL with literals replaced by '?' and lists of '?' collapsed.
+
+	>>> fingerprint("select * from  user2 where id=123 and name='Bob' and x in (?, ?,?)")
+	'select * from user2 where id=? and name=? and x in (?+)'
+	>>> fingerprint('SELECT * FROM user WHERE id IN (?)')
+	'select * from user where id in (?+)'
+	>>> fingerprint('insert into user (id,name) values (?,?),(?,?),(?,?)')
+	'insert into user (id,name) values (?+)+'
+	'''
+	sql = _RE_STRING.sub('?', sql)
+	sql = _RE_NUMBER.sub('?', sql)
+	sql = _RE_LIST.sub('(?+)', sql)
+	sql = _RE_ROWS.sub('(?+)+', sql)
+	return _RE_SPACES.sub(' ', sql).strip().lower()
+
+
+# upper bounds of latency buckets in seconds:
+_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, float('inf'))
+
+# fingerprints beyond this number are counted as '(others)':
+_MAX_FINGERPRINTS = 1000
+
+class _Stat(object):
+	'''
+	Latency statistics of a fingerprint.
+
+	>>> s = _Stat()
+	>>> for t in (0.0001, 0.0003, 0.003, 0.004, 0.3):
+	... 	s.add(t, 1)
+	>>> s.count, s.rows
+	(5, 5)
+	>>> s.percentile(0.5), s.percentile(0.99)
+	(0.005, 0.3)
+	'''
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.rows = 0
+		self.buckets = [0] * len(_BUCKETS)
+
+	def add(self, elapsed, rows):
+		self.count = self.count + 1
+		self.total = self.total + elapsed
+		self.max = max(self.max, elapsed)
+		self.rows = self.rows + rows
+		self.buckets[bisect.bisect_left(_BUCKETS, elapsed)] += 1
+
+	def percentile(self, p):
+		'''
+		Return upper bound of the bucket where the percentile falls in, but not more than max.
+		'''
+		n = 0
+		for bound, count in zip(_BUCKETS, self.buckets):
+			n = n + count
+			if n >= p * self.count:
+				return min(bound, self.max)
+		return self.max
+
+
+class _Scope(object):
+	'''
+	Queries recorded in a request or a function call.
+	'''
+	def __init__(self, name=None, detect=False):
+		self.name = name
+		self.count = 0
+		self.elapsed = 0.0
+		self._detect = detect
+		self._fingerprints = {}
+		# a scope is shared by threads of db.gather():
+		self._lock = threading.Lock()
+
+	def add(self, fp, elapsed):
+		n = 0
+		with self._lock:
+			self.count = self.count + 1
+			self.elapsed = self.elapsed + elapsed
+			if self._detect:
+				n = self._fingerprints.get(fp, 0) + 1
+				self._fingerprints[fp] = n
+		if n and n == detect_threshold:
+			logging.warning('[PROFILING] [N+1] %s repeated %d times in %s:\n%s' % (fp, n, self.name or 'request', call_site()))
+
+	def __enter__(self):
+		_current().append(self)
+		return self
+
+	def __exit__(self, exctype, excvalue, traceback):
+		_current().remove(self)
+
+
+_TRANSWARP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def call_site():
+	'''
+	Return stack of caller outside transwarp.
+	'''
+	frames = [f for f in traceback.extract_stack() if os.path.dirname(os.path.abspath(f[0])) != _TRANSWARP_DIR]
+	return ''.join(traceback.format_list(frames[-8:]))
+
+
+_local = threading.local()
+
+def _current():
+	scopes = getattr(_local, 'scopes', None)
+	if scopes is None:
+		scopes = _local.scopes = []
+	return scopes
+
+
+def current_scopes():
+	'''
+	Return active scopes of current thread, used to pass them to other threads.
+	'''
+	return list(_current())
+
+
+def bind_scopes(scopes):
+	'''
+	Record queries of current thread to scopes of another thread.
+	'''
+	_local.scopes = list(scopes)
+
+
+_lock = threading.Lock()
+_statements = {} # fingerprint => _Stat
+_requests = {} # request name => [requests, queries, max queries, db time]
+_slow = deque(maxlen=100) # recent slow statements
+_counters = {} # name => count
+
+
+def record(sql, elapsed, rows=0):
+	'''
+	Record an executed SQL statement.
+	'''
+	if not enabled:
+		return
+	fp = fingerprint(sql)
+	with _lock:
+		stat = _statements.get(fp)
+		if stat is None:
+			if len(_statements) >= _MAX_FINGERPRINTS:
+				fp = '(others)'
+			stat = _statements.setdefault(fp, _Stat())
+		stat.add(elapsed, rows)
+	for scope in _current():
+		scope.add(fp, elapsed)
+
+
+class _RequestCtx(object):
+
+	def __init__(self, name):
+		self.scope = _Scope(name, detect=detect_threshold > 0)
+
+	def __enter__(self):
+		return self.scope.__enter__()
+
+	def __exit__(self, exctype, excvalue, traceback):
+		scope = self.scope
+		scope.__exit__(exctype, excvalue, traceback)
+		if not enabled:
+			return
+		with _lock:
+			r = _requests.get(scope.name)
+			if r is None:
+				r = _requests[scope.name] = [0, 0, 0, 0.0]
+			r[0] = r[0] + 1
+			r[1] = r[1] + scope.count
+			r[2] = max(r[2], scope.count)
+			r[3] = r[3] + scope.elapsed
+
+
+def request(name=None):
+	'''
+	Return context object that counts queries of a request. The name can be
+	set to the returned scope later, e.g. after the route is matched.
+
+	>>> with request('GET /test') as p:
+	... 	record('select * from user where id=1', 0.001)
+	... 	record('select * from user where id=2', 0.001)
+	>>> p.count
+	2
+	>>> snapshot()['requests'][0]['max_queries']
+	2
+	>>> reset()
+	'''
+	return _RequestCtx(name)
+
+
+class QueryBudgetError(StandardError):
+	pass
+
+
+def _is_strict(override):
+	return strict if override is None else override
+
+
+def query_budget(max_queries, strict=None):
+	'''
+	Decorator that limits number of queries in function.
+
+	>>> @query_budget(1, strict=True)
+	... def load():
+	... 	record('select * from user', 0.001)
+	... 	record('select * from blog', 0.001)
+	>>> load()
+	Traceback (most recent call last):
+		...
+	QueryBudgetError: load() executed 2 queries, budget is 1.
+	>>> reset()
+	'''
+	def _decorator(func):
+		@functools.wraps(func)
+		def _wrapper(*args, **kw):
+			with _Scope('%s()' % func.__name__) as scope:
+				r = func(*args, **kw)
+			if scope.count > max_queries:
+				msg = '%s executed %d queries, budget is %d.' % (scope.name, scope.count, max_queries)
+				if _is_strict(strict):
+					raise QueryBudgetError(msg)
+				logging.warning('[PROFILING] [BUDGET] %s' % msg)
+			return r
+		return _wrapper
+	return _decorator
+
+
+def incr(name, n=1):
+	'''
+	Increase the counter of an event.
+
+	>>> incr('transaction.retries')
+	>>> incr('transaction.retries', 2)
+	>>> snapshot()['counters']
+	{'transaction.retries': 3}
+	>>> reset()
+	'''
+	with _lock:
+		_counters[name] = _counters.get(name, 0) + n
+
+
+def counters():
+	'''
+	Return counters of events as dict.
+	'''
+	with _lock:
+		return dict(_counters)
+
+
+def snapshot():
+	'''
+	Return statistics of statements and requests, both ordered by total db time,
+	and the counters.
+
+	>>> record('select * from user where id=1', 0.001, 1)
+	>>> record('select * from user where id=2', 0.003, 1)
+	>>> s = snapshot()['statements'][0]
+	>>> s['fingerprint'], s['count'], s['rows'], s['p50'], s['p99']
+	('select * from user where id=?', 2, 2, 0.001, 0.003)
+	>>> reset()
+	'''
+	with _lock:
+		statements = [dict(fingerprint=fp, count=s.count, total=s.total, avg=s.total / s.count, max=s.max, rows=s.rows, p50=s.percentile(0.5), p95=s.percentile(0.95), p99=s.percentile(0.99)) for fp, s in _statements.iteritems()]
+		requests = [dict(name=name, requests=r[0], queries=r[1], avg_queries=float(r[1]) / r[0], max_queries=r[2], total=r[3]) for name, r in _requests.iteritems()]
+		counters = dict(_counters)
+	statements.sort(key=lambda s: s['total'], reverse=True)
+	requests.sort(key=lambda r: r['total'], reverse=True)
+	return dict(statements=statements, requests=requests, counters=counters)
+
+
+def record_slow(entry):
+	'''
+	Store a slow statement (dict with sql, duration, plan, call_site, etc.) and log
+	it as a JSON line.
+
+	>>> record_slow(dict(sql='select * from user', duration=0.5, plan=[]))
+	>>> slow_queries()[0]['sql']
+	'select * from user'
+	>>> reset()
+	'''
+	_slow.append(entry)
+	logging.warning('[PROFILING] [SLOW] %s' % json.dumps(entry, default=str))
+
+
+def slow_queries():
+	'''
+	Return recent slow statements, newest first.
+	'''
+	return list(reversed(_slow))
+
+
+def reset():
+	with _lock:
+		_statements.clear()
+		_requests.clear()
+		_slow.clear()
+		_counters.clear()
+
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
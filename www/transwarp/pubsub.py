@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+In-process publish / subscribe hub for Server-Sent Events. This module is
+independent with web and db module.
+
+Each process has one hub. A message published to a channel is appended to the
+buffer of every subscriber of the channel, and the subscriber is woken up. The
+message is sent as is, so format it once by sse_event() before publishing,
+instead of once for each client.
+
+Nothing is done for an idle subscriber, it only waits in stream() and sends a
+heartbeat comment every heartbeat seconds, so proxies do not close the
+connection. Waiting takes no thread only if the process is patched by gevent,
+see cooperative(). A subscriber whose buffer is full is closed: its stream ends
+and the browser reconnects with the id of the last event received.
+
+Messages are not shared between processes, a subscriber receives only the
+messages published in the same process.
+'''
+
+import threading
+from collections import deque
+
+import profiler
+
+
+def cooperative():
+	'''
+	Return True if threading is patched by gevent, so a subscriber waiting for
+	messages takes a greenlet instead of a thread.
+	'''
+	try:
+		from gevent import monkey
+	except ImportError:
+		return False
+	return monkey.is_module_patched('threading')
+
+
+def sse_event(data, event=None, id=None):
+	'''
+	Format a Server-Sent Event.
+
+	>>> sse_event('{"a":1}', event='comment', id='1.5')
+	'id: 1.5\\nevent: comment\\ndata: {"a":1}\\n\\n'
+	>>> sse_event('a\\nb')
+	'data: a\\ndata: b\\n\\n'
+	'''
+	L = []
+	if id is not None:
+		L.append('id: %s\n' % id)
+	if event is not None:
+		L.append('event: %s\n' % event)
+	for line in data.split('\n'):
+		L.append('data: %s\n' % line)
+	L.append('\n')
+	return ''.join(L)
+
+
+class Subscription(object):
+	'''
+	Messages of a channel received by one client.
+	'''
+	def __init__(self, hub, channel):
+		self.channel = channel
+		self.overflowed = False
+		self._hub = hub
+		self._messages = deque()
+		self._ready = threading.Event()
+		self._closed = False
+
+	def get(self, timeout=None):
+		'''
+		Wait at most timeout seconds, return list of messages, empty list if
+		timeout, or None if the subscription is closed.
+		'''
+		if not self._messages and not self._closed:
+			self._ready.wait(timeout)
+		with self._hub._lock:
+			self._ready.clear()
+			L = list(self._messages)
+			self._messages.clear()
+		if not L and self._closed:
+			return None
+		return L
+
+	def close(self):
+		self._hub._unsubscribe(self)
+
+
+class Hub(object):
+	'''
+	>>> h = Hub(max_buffer=2)
+	>>> s1, s2 = h.subscribe('blog:1'), h.subscribe('blog:1')
+	>>> h.publish('blog:1', 'a'), h.publish('blog:2', 'x')
+	(2, 0)
+	>>> s1.get(0), s2.get(0)
+	(['a'], ['a'])
+	>>> s1.get(0.01)
+	[]
+	>>> h.publish('blog:1', 'b'), s2.get(0)
+	(2, ['b'])
+	>>> h.publish('blog:1', 'c'), h.publish('blog:1', 'd')
+	(2, 1)
+	>>> s1.overflowed, s1.get(0), s1.get(0)
+	(True, ['b', 'c'], None)
+	>>> h.subscribers()
+	1
+	>>> s2.get(0)
+	['c', 'd']
+	>>> t = threading.Timer(0.05, h.publish, ('blog:1', 'e'))
+	>>> t.start()
+	>>> s2.get(1)
+	['e']
+	>>> s2.close()
+	>>> h.subscribers()
+	0
+	>>> list(Hub().stream('blog:1', heartbeat=0.01, first=lambda: ['x'], limit=3))
+	['retry: 3000\\n\\n', 'x', ': heartbeat\\n\\n']
+	>>> h.stream('blog:1').close()
+	>>> h.subscribers()
+	0
+	>>> profiler.reset()
+	'''
+	def __init__(self, max_buffer=100):
+		self.max_buffer = max_buffer
+		# channel => set of Subscription:
+		self._channels = {}
+		self._lock = threading.Lock()
+
+	def subscribe(self, channel):
+		s = Subscription(self, channel)
+		with self._lock:
+			self._channels.setdefault(channel, set()).add(s)
+		return s
+
+	def _unsubscribe(self, s):
+		with self._lock:
+			s._closed = True
+			subs = self._channels.get(s.channel)
+			if subs is not None:
+				subs.discard(s)
+				if not subs:
+					del self._channels[s.channel]
+		s._ready.set()
+
+	def publish(self, channel, message):
+		'''
+		Send message to subscribers of channel, return number of subscribers received.
+		'''
+		n = 0
+		overflowed = []
+		with self._lock:
+			for s in self._channels.get(channel, ()):
+				if len(s._messages) >= self.max_buffer:
+					overflowed.append(s)
+					continue
+				s._messages.append(message)
+				s._ready.set()
+				n = n + 1
+		for s in overflowed:
+			# client is too slow, it resumes from the last event after reconnecting:
+			s.overflowed = True
+			s.close()
+			profiler.incr('pubsub.overflows')
+		profiler.incr('pubsub.published')
+		return n
+
+	def subscribers(self):
+		with self._lock:
+			return sum(len(subs) for subs in self._channels.itervalues())
+
+	def stream(self, channel, heartbeat=15.0, first=None, limit=0):
+		'''
+		Return a generator of Server-Sent Events of channel for WSGI response.
+
+		Args:
+			heartbeat: seconds between heartbeats of idle connection.
+			first: function returns messages sent before the published ones, it is
+				called after subscribing so no message is missed in between.
+			limit: end the stream after sending limit items, 0 means never.
+		'''
+		s = self.subscribe(channel)
+		try:
+			# browser reconnects after 3 seconds if the stream ends:
+			items = ['retry: 3000\n\n']
+			if first:
+				items.extend(first())
+		except Exception:
+			s.close()
+			raise
+		def _gen():
+			try:
+				sent = 0
+				L = items
+				while True:
+					for item in L:
+						yield item
+						sent = sent + 1
+						if limit and sent >= limit:
+							return
+					L = s.get(heartbeat)
+					if L is None:
+						return
+					if not L:
+						L = [': heartbeat\n\n']
+			finally:
+				s.close()
+		return _Stream(_gen(), s)
+
+
+class _Stream(object):
+	'''
+	Iterator of stream(), closing it also unsubscribes if it is never started.
+	'''
+	def __init__(self, gen, subscription):
+		self._gen = gen
+		self._subscription = subscription
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		return self._gen.next()
+
+	def close(self):
+		self._gen.close()
+		self._subscription.close()
+
+
+# the hub of current process:
+hub = Hub()
+
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
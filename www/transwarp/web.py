@@ -14,6 +14,8 @@ try:
 except ImportError:
 	from StringIO import StringIO
 
+import metrics
+
 # 全局ThreadLocal对象,thread local object for storing request and response
 
 ctx = threading.local()
@@ -544,6 +546,8 @@ class Route(object):
 		return None
 
 	def __call__(self, *args):
+		# the matched route, e.g. '/blog/:blog_id':
+		ctx.request.route = self.path
 		return self.func(*args)
 
 	def __str__(self):
@@ -574,6 +578,7 @@ class StaticFileRoute(object):
 		return None
 
 	def __call__(self, *args):
+		ctx.request.route = '/static/:path'
 		fpath = os.path.join(ctx.application.document_root, args[0])
 		if not os.path.isfile(fpath):
 			raise notfound()
@@ -1208,6 +1213,7 @@ class Template(object):
 		'''
 		self.template_name = template_name
 		self.model = dict(**kw)
+		self.stream = False
 
 class TemplateEngine(object):
 	'''
@@ -1216,6 +1222,13 @@ class TemplateEngine(object):
 	def __call__(self, path, model):
 		return '<!-- override this method to render template -->'
 
+	def stream(self, path, model, chunk_size=0):
+		'''
+		Render template as an iterable of str. Override this method to render
+		template incrementally.
+		'''
+		return [self(path, model)]
+
 class Jinja2TemplateEngine(TemplateEngine):
 	'''
 	Render using jinjia2 template engine.
@@ -1225,20 +1238,77 @@ class Jinja2TemplateEngine(TemplateEngine):
 	>>> engine.add_filter('datetime', lambda dt: dt.strftime('%Y-%m-%d %H:%M:%S'))
 	>>> engine('jinja2-test.html', dict(name='Michael', posted_at=datetime.datetime(2014, 6, 1, 10, 11, 12)))
 	'<p>Hello, Michael.</p><span>2014-06-01 10:11:12</span>'
+	>>> engine.precompile()
+	1
+	>>> list(engine.stream('jinja2-test.html', dict(name='Michael', posted_at=datetime.datetime(2014, 6, 1, 10, 11, 12)), 16))
+	['<p>Hello, Michael', '.</p><span>2014-06-01 10:11:12', '</span>']
 	'''
 
-	def __init__(self, templ_dir, **kw):
-		from jinja2 import Environment, FileSystemLoader
+	def __init__(self, templ_dir, chunk_size=8192, cache_dir=None, fragment_cache=None, **kw):
+		'''
+		Init jinja2 environment.
+
+		Args:
+			templ_dir: template directory.
+			chunk_size: default size of chunks in bytes when rendering by stream().
+			cache_dir: directory to store compiled templates across processes, default to None (no cache).
+			fragment_cache: TaggedCache object used by {% cache %} tag, default to cache.fragments.
+			kw: other args passed to jinja2 Environment, e.g. auto_reload=False to
+				skip checking the template file on every render in production.
+		'''
+		from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+		from fragment import FragmentCacheExtension
+		import cache
 		if not 'autoescape' in kw:
 			kw['autoescape'] = True
+		if cache_dir:
+			if not os.path.isdir(cache_dir):
+				os.makedirs(cache_dir)
+			kw['bytecode_cache'] = FileSystemBytecodeCache(cache_dir)
+		kw['extensions'] = list(kw.get('extensions', [])) + [FragmentCacheExtension]
 		self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)
+		self._env.fragment_cache = cache.fragments if fragment_cache is None else fragment_cache
+		self._chunk_size = chunk_size
 
 	def add_filter(self, name, fn_filter):
 		self._env.filters[name] = fn_filter
 
+	def precompile(self, extensions=('html',)):
+		'''
+		Load and compile all templates now, so that the first requests do not pay
+		the compile cost. Return the number of templates loaded.
+		'''
+		names = self._env.list_templates(extensions=extensions)
+		for name in names:
+			self._env.get_template(name)
+		logging.info('Precompiled %d templates.' % len(names))
+		return len(names)
+
 	def __call__(self, path, model):
 		return self._env.get_template(path).render(**model).encode('utf-8')
 
+	def stream(self, path, model, chunk_size=0):
+		'''
+		Render template by jinja2 generate() and return an iterator of utf-8
+		encoded chunks, each one is at least chunk_size bytes except the last.
+		'''
+		# load template now so that a missing template fails before response starts:
+		return _chunked(self._env.get_template(path).generate(**model), chunk_size or self._chunk_size)
+
+def _chunked(fragments, chunk_size):
+	L = []
+	n = 0
+	for s in fragments:
+		s = s.encode('utf-8')
+		L.append(s)
+		n = n + len(s)
+		if n >= chunk_size:
+			yield ''.join(L)
+			L = []
+			n = 0
+	if L:
+		yield ''.join(L)
+
 def _default_error_handler(e, start_response, is_debug):
 	if isinstance(e, HttpError):
 		logging.info('HttpError: %s' % e.status)
@@ -1252,9 +1322,10 @@ def _default_error_handler(e, start_response, is_debug):
 		return _debug()
 	return ('<html><body><h1>500 Internal Server Error</h1><h3>%s</h3></body></html>' % str(e))
 
-def view(path):
+def view(path, stream=False):
 	'''
-	A view decorator that render a view by dict.
+	A view decorator that render a view by dict. Set stream=True to send the
+	page in chunks while rendering, or set stream to an int as the chunk size.
 
 	>>> @view('test/view.html')
 	... def hello():
@@ -1264,6 +1335,13 @@ def view(path):
 	True
 	>>> t.template_name
 	'test/view.html'
+	>>> t.stream
+	False
+	>>> @view('test/view.html', stream=4096)
+	... def hello1():
+	...     return dict(name='Bob')
+	>>> hello1().stream
+	4096
 	>>> @view('test/view.html')
 	... def hello2():
 	...     return ['a list']
@@ -1278,7 +1356,9 @@ def view(path):
 			r = func(*args, **kw)
 			if isinstance(r, dict):
 				logging.info('return Template')
-				return Template(path, **r)
+				t = Template(path, **r)
+				t.stream = stream
+				return t
 			raise ValueError('Expect return a dict when using @view() decorator.')
 		return _wrapper
 	return _decorator
@@ -1366,6 +1446,93 @@ def _build_interceptor_chain(last_fn, *interceptors):
 		fn = _build_interceptor_fn(f, fn)
 	return fn
 
+def subrequest(method, path, params=None):
+	r'''
+	Prepare a sub request of the current request and return a function that
+	dispatches it and returns (status, content_type, body). The sub request has
+	the environ of the current request (cookies, headers) and the attributes
+	bound to ctx.request by interceptors (e.g. the signed in user), and goes
+	through the interceptors again, so each sub request gets its own per-request
+	state like profiling and identity map. The returned function can be called
+	in another thread. A handler returning an iterator gets '400 Bad Request'.
+
+	>>> @get('/sub/:id')
+	... def sub(id):
+	...     return 'id=%s, x=%s, user=%s' % (id, ctx.request.get('x'), ctx.request.user)
+	>>> app = WSGIApplication()
+	>>> app.add_url(sub)
+	>>> ctx.application = Dict(router=app._build_router())
+	>>> ctx.request = Request({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/batch'})
+	>>> ctx.request.user = 'Bob'
+	>>> subrequest('GET', '/sub/123', dict(x=u'\u4e2d'))()
+	('200 OK', 'text/html; charset=utf-8', 'id=123, x=\xe4\xb8\xad, user=Bob')
+	>>> subrequest('GET', '/sub/456?x=1')()[2]
+	'id=456, x=1, user=Bob'
+	>>> subrequest('GET', '/notfound')()[0]
+	'404 Not Found'
+	>>> @get('/stream')
+	... def stream():
+	...     return iter(['a', 'b'])
+	>>> app.add_url(stream)
+	>>> ctx.application = Dict(router=app._build_router())
+	>>> subrequest('GET', '/stream')()[0]
+	'400 Bad Request'
+	>>> def tag(next):
+	...     return 'intercepted ' + next()
+	>>> ctx.application = Dict(router=app._build_router(), handler=_build_interceptor_chain(app._build_router(), interceptor('/sub/')(tag)))
+	>>> subrequest('GET', '/sub/789')()[2]
+	'intercepted id=789, x=None, user=Bob'
+	'''
+	parent = ctx.request
+	# the router wrapped by interceptors, or the bare router if no application is running:
+	router = ctx.application.get('handler') or ctx.application.router
+	qs = urllib.urlencode([(_to_str(k), _to_str(v)) for k, v in (params or {}).iteritems()])
+	path, _, path_qs = path.partition('?')
+	env = dict(parent.environ)
+	env['REQUEST_METHOD'] = method
+	env['PATH_INFO'] = path
+	if method=='POST':
+		env['QUERY_STRING'] = path_qs
+		env['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+		env['CONTENT_LENGTH'] = str(len(qs))
+		env['wsgi.input'] = StringIO(qs)
+	else:
+		env['QUERY_STRING'] = '&'.join(filter(None, [path_qs, qs]))
+		env['CONTENT_LENGTH'] = '0'
+		env['wsgi.input'] = StringIO('')
+	request = Request(env)
+	for k, v in parent.__dict__.iteritems():
+		if not k.startswith('_'):
+			setattr(request, k, v)
+	application = ctx.application
+
+	def _dispatch():
+		saved = [getattr(ctx, k, None) for k in ('application', 'request', 'response')]
+		ctx.application = application
+		ctx.request = request
+		response = ctx.response = Response()
+		try:
+			r = router()
+			if isinstance(r, Template):
+				raise ValueError('Cannot render template in sub request.')
+			if isinstance(r, unicode):
+				r = r.encode('utf-8')
+			elif r is None:
+				r = ''
+			elif isinstance(r, (list, tuple)):
+				r = ''.join(r)
+			elif not isinstance(r, str):
+				# a streamed body may never end, e.g. Server-Sent Events:
+				if hasattr(r, 'close'):
+					r.close()
+				return '400 Bad Request', response.content_type, ''
+			return response.status, response.content_type, r
+		except HttpError, e:
+			return e.status, response.content_type, ''
+		finally:
+			ctx.application, ctx.request, ctx.response = saved
+	return _dispatch
+
 def _load_module(module_name):
 	'''
 	Load module from name as str.
@@ -1451,20 +1618,35 @@ class WSGIApplication(object):
 		self._interceptors.append(func)
 		logging.info('Add interceptor: %s' % str(func))
 
-	def run(self, port=9000, host='127.0.0.1'):
-		from wsgiref.simple_server import make_server
-		logging.info('application (%s) will start at %s:%s...' % (self._document_root, host, port))
-		server = make_server(host, port, self.get_wsgi_application(debug=True))
-		server.serve_forever()
-
-	def get_wsgi_application(self, debug=False):
-		self._check_not_running()
-		if debug:
-			self._get_dynamic.append(StaticFileRoute())
-		self._running = True
+	def run(self, port=9000, host='127.0.0.1', server='wsgiref', pool_size=1000):
+		'''
+		Start a local server for development and test.
 
-		_application = Dict(document_root=self._document_root)
+		Args:
+			port: listen port, default to 9000.
+			host: listen address, default to '127.0.0.1'.
+			server: 'wsgiref' handles one request at a time; 'gevent' serves each
+					connection in a greenlet, the same model as the gunicorn gevent
+					worker used in production. gevent.monkey.patch_all() should be
+					called before other modules are imported.
+			pool_size: max concurrent connections when using gevent.
+		'''
+		logging.info('application (%s) will start at %s:%s (%s)...' % (self._document_root, host, port, server))
+		app = self.get_wsgi_application(debug=True)
+		if server=='gevent':
+			from gevent.pool import Pool
+			from gevent.pywsgi import WSGIServer
+			WSGIServer((host, port), app, spawn=Pool(pool_size)).serve_forever()
+			return
+		if server!='wsgiref':
+			raise ValueError('Unsupported server: %s' % server)
+		from wsgiref.simple_server import make_server
+		make_server(host, port, app).serve_forever()
 
+	def _build_router(self):
+		'''
+		Return a function that finds the route of ctx.request and calls it.
+		'''
 		def fn_route():
 			request_method = ctx.request.request_method
 			path_info = ctx.request.path_info
@@ -1488,16 +1670,37 @@ class WSGIApplication(object):
 				raise notfound()
 			raise badrequest()
 
+		return fn_route
+
+	def get_wsgi_application(self, debug=False):
+		self._check_not_running()
+		if debug:
+			self._get_dynamic.append(StaticFileRoute())
+		self._running = True
+
+		fn_route = self._build_router()
 		fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+		_application = Dict(document_root=self._document_root, router=fn_route, handler=fn_exec)
 
-		def wsgi(env, start_response):
+		def _wsgi(env, start_response, m):
 			ctx.application = _application
 			ctx.request = Request(env)
 			response = ctx.response = Response()
 			try:
-				r = fn_exec()
+				try:
+					r = fn_exec()
+				finally:
+					# also for redirects and errors:
+					if m:
+						m.handled()
 				if isinstance(r, Template):
-					r = self._template_engine(r.template_name, r.model)
+					if r.stream:
+						chunk_size = 0 if r.stream is True else r.stream
+						r = self._template_engine.stream(r.template_name, r.model, chunk_size)
+					else:
+						r = self._template_engine(r.template_name, r.model)
+					if m:
+						m.rendered()
 				if isinstance(r, unicode):
 					r = r.encode('utf-8')
 				if r is None:
@@ -1527,10 +1730,24 @@ class WSGIApplication(object):
 					stacks.replace('<', '&lt;').replace('>', '&gt;'),
 					'</pre></div></body></html>']
 			finally:
+				if m:
+					m.route = getattr(ctx.request, 'route', None)
 				del ctx.application
 				del ctx.request
 				del ctx.response
 
+		def wsgi(env, start_response):
+			if not metrics.enabled:
+				return _wsgi(env, start_response, None)
+			# time of handler, template and database, and size of body:
+			m = metrics.begin()
+			try:
+				r = _wsgi(env, m.start_response(start_response), m)
+			except BaseException:
+				m.finish(env.get('REQUEST_METHOD'), m.route, [])
+				raise
+			return m.finish(env.get('REQUEST_METHOD'), m.route, r)
+
 		return wsgi
 
 if __name__ == '__main__':
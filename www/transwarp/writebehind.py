@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jack Bai'
+
+'''
+Write-behind buffers for high-volume writes.
+
+WriteBehindQueue buffers inserts of a table and writes them by batch with one
+multi-row insert, for tables with bursts of small inserts like comments.
+
+A background thread writes the queued rows when batch_size rows are queued or
+interval seconds after the first one. put() waits at most timeout seconds if
+max_pending rows are not written yet, and returns False if the queue is still
+full, so the caller can insert directly. Rows being written are still returned
+by pending() until they are committed.
+
+WriteBehindCounter adds up increments like page views in memory, and passes
+them to a flush function every interval seconds, so the database gets one write
+per interval instead of one per increment.
+
+All rows and counts are written when the process exits normally. Those not
+written yet are lost if the process crashes.
+'''
+
+import json, time, atexit, logging, threading
+from collections import deque
+
+import db, profiler
+
+# attempts of writing a batch before writing its rows one by one:
+_BATCH_ATTEMPTS = 3
+
+# max seconds between attempts:
+_MAX_BACKOFF = 10.0
+
+
+class WriteBehindQueue(object):
+	'''
+	>>> written = []
+	>>> q = WriteBehindQueue('t', batch_size=2, interval=0.05, insert=lambda table, rows: written.append(rows))
+	>>> q.put(dict(id=1)), q.put(dict(id=2)), q.put(dict(id=3))
+	(True, True, True)
+	>>> q.close()
+	>>> [r['id'] for rows in written for r in rows]
+	[1, 2, 3]
+	>>> q = WriteBehindQueue('t', interval=10, max_pending=1, timeout=0.01, insert=lambda table, rows: None)
+	>>> q.put(dict(id=1)), q.put(dict(id=2))
+	(True, False)
+	>>> q.pending()
+	[{'id': 1}]
+	>>> q.close()
+	>>> q.pending()
+	[]
+	>>> profiler.reset()
+	'''
+	def __init__(self, table, batch_size=100, interval=0.2, max_pending=10000, timeout=1.0, insert=None):
+		self.table = table
+		self.batch_size = batch_size
+		self.interval = interval
+		self.max_pending = max_pending
+		self.timeout = timeout
+		# function(table, rows) that writes rows:
+		self.insert = insert or db.insert_many
+		self._rows = deque()
+		self._writing = []
+		self._cond = threading.Condition()
+		self._thread = None
+		self._closed = False
+		atexit.register(self.close)
+
+	def put(self, row):
+		'''
+		Queue a row (dict of column => value), return False if the queue is full.
+		'''
+		with self._cond:
+			deadline = time.time() + self.timeout
+			while len(self._rows) + len(self._writing) >= self.max_pending and not self._closed:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				self._cond.wait(remaining)
+			if self._closed or len(self._rows) + len(self._writing) >= self.max_pending:
+				profiler.incr('write_behind.full')
+				return False
+			self._rows.append(row)
+			if len(self._rows)==1 or len(self._rows)==self.batch_size:
+				self._cond.notify_all()
+			if self._thread is None:
+				# started by first put, so it runs in the worker process after fork:
+				self._thread = threading.Thread(target=self._run, name='write-behind-%s' % self.table)
+				self._thread.daemon = True
+				self._thread.start()
+		return True
+
+	def pending(self):
+		'''
+		Return rows not committed yet.
+		'''
+		with self._cond:
+			return list(self._writing) + list(self._rows)
+
+	def close(self):
+		'''
+		Stop the background thread and write all queued rows.
+		'''
+		with self._cond:
+			self._closed = True
+			self._cond.notify_all()
+		if self._thread is not None:
+			self._thread.join()
+		while True:
+			batch = self._take()
+			if not batch:
+				break
+			self._write(batch)
+
+	def _take(self):
+		with self._cond:
+			n = min(self.batch_size, len(self._rows))
+			self._writing = [self._rows.popleft() for i in xrange(n)]
+			return self._writing
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._rows and not self._closed:
+					self._cond.wait()
+				deadline = time.time() + self.interval
+				while len(self._rows) < self.batch_size and not self._closed:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						break
+					self._cond.wait(remaining)
+				if self._closed:
+					# close() writes the rest:
+					return
+			self._write(self._take())
+
+	def _write(self, batch):
+		attempt = 0
+		while True:
+			try:
+				with db.connection():
+					self.insert(self.table, batch)
+				break
+			except Exception, e:
+				attempt = attempt + 1
+				logging.exception('write %d rows to %s failed, attempt %d.' % (len(batch), self.table, attempt))
+				# keep retrying while database is unreachable, put() falls back to direct insert when full:
+				if attempt >= _BATCH_ATTEMPTS and (self._closed or not db._is_connection_error(e)):
+					batch = self._write_each(batch)
+					break
+				time.sleep(min(self.interval * (2 ** attempt), _MAX_BACKOFF))
+		profiler.incr('write_behind.batches')
+		profiler.incr('write_behind.rows', len(batch))
+		with self._cond:
+			self._writing = []
+			# wake up put() waiting for space:
+			self._cond.notify_all()
+
+	def _write_each(self, batch):
+		# find out the bad rows, they are logged and dropped:
+		written = []
+		for row in batch:
+			try:
+				with db.connection():
+					self.insert(self.table, [row])
+				written.append(row)
+			except Exception:
+				logging.exception('drop row of %s: %s' % (self.table, json.dumps(row, default=str)))
+				profiler.incr('write_behind.dropped')
+		return written
+
+
+class WriteBehindCounter(object):
+	'''
+	>>> flushed = []
+	>>> c = WriteBehindCounter(lambda counts: flushed.append(counts), interval=10)
+	>>> c.incr('a'); c.incr('a'); c.incr('b', 3)
+	>>> c.pending('a')
+	2
+	>>> c.flush()
+	>>> flushed
+	[{'a': 2, 'b': 3}]
+	>>> c.pending('a')
+	0
+	>>> c.close()
+	>>> profiler.reset()
+	'''
+	def __init__(self, flush, interval=10.0):
+		self.interval = interval
+		self._flush = flush
+		self._counts = {}
+		self._lock = threading.Lock()
+		self._thread = None
+		self._stopped = threading.Event()
+		atexit.register(self.close)
+
+	def incr(self, key, n=1):
+		with self._lock:
+			self._counts[key] = self._counts.get(key, 0) + n
+			if self._thread is None and not self._stopped.is_set():
+				# started by first incr, so it runs in the worker process after fork:
+				self._thread = threading.Thread(target=self._run, name='write-behind-counter')
+				self._thread.daemon = True
+				self._thread.start()
+
+	def pending(self, key):
+		'''
+		Return count of key not flushed yet.
+		'''
+		with self._lock:
+			return self._counts.get(key, 0)
+
+	def flush(self):
+		with self._lock:
+			counts, self._counts = self._counts, {}
+		if not counts:
+			return
+		try:
+			with db.connection():
+				self._flush(counts)
+			profiler.incr('write_behind.counter_flushes')
+		except Exception:
+			logging.exception('flush %d counts failed, retry later.' % len(counts))
+			with self._lock:
+				for k, n in counts.iteritems():
+					self._counts[k] = self._counts.get(k, 0) + n
+
+	def close(self):
+		'''
+		Stop the background thread and flush the counts.
+		'''
+		self._stopped.set()
+		if self._thread is not None:
+			self._thread.join()
+		self.flush()
+
+	def _run(self):
+		while not self._stopped.wait(self.interval):
+			self.flush()
+
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
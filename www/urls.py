@@ -4,11 +4,15 @@
 __author__ = 'Jack Bai'
 
 
-import logging, os, re, time, base64, hashlib
+import logging, os, re, time, json, base64, hashlib
 import markdown2
 
-from transwarp.web import get, post, ctx, view, interceptor, seeother, notfound
+from transwarp import db, profiler, pubsub, metrics
+from transwarp.web import get, post, ctx, view, interceptor, seeother, notfound, badrequest, subrequest, HttpError
+from transwarp.orm import prefetch, cache_stats
+from transwarp.profiler import query_budget
 from models import User, Blog, Comment
+import search, pageviews
 
 from apis import api, Page, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
 from config import configs
@@ -18,6 +22,20 @@ _COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
 
 
+def _get_fields(model):
+	'''
+	Get field names of model from 'fields' parameter like 'fields=id,name', or None for all fields.
+	'''
+	s = ctx.request.get('fields', '')
+	if not s:
+		return None
+	fields = [f.strip() for f in s.split(',') if f.strip()]
+	for f in fields:
+		if not f in model.__mappings__:
+			raise APIValueError('fields', 'Invalid field: %s' % f)
+	return fields
+
+
 def _get_page_index():
 	page_index = 1
 	try:
@@ -60,6 +78,31 @@ def check_admin():
 	raise APIPermissionError('No permission.')
 
 
+# 统计每个请求的SQL查询次数，按路由汇总:
+@interceptor('/')
+def profiler_interceptor(next):
+	with profiler.request() as p:
+		try:
+			return next()
+		finally:
+			p.name = '%s %s' % (ctx.request.request_method, getattr(ctx.request, 'route', None) or '(unmatched)')
+
+
+# 每个请求使用一个identity map，同一请求内按主键重复加载的对象直接复用，
+# /api/batch的子请求也各自使用一个，修改加载的对象不会影响其他子请求：
+@interceptor('/')
+def identity_map_interceptor(next):
+	with db.identity_map(fresh=True):
+		return next()
+
+
+# select goes to a replica until the request writes, then to the primary:
+@interceptor('/')
+def read_your_writes_interceptor(next):
+	with db.read_your_writes():
+		return next()
+
+
 # 利用拦截器在处理URL之前，把cookie解析出来，
 # 并将登录用户绑定到ctx.request对象上，
 # 这样，后续的URL处理函数就可以直接拿到登录用户：
@@ -85,22 +128,77 @@ def manage_interceptor(next):
 	raise seeother('/signin')
 
 
+# number of blogs in the popular widget:
+_HOT_BLOGS = 5
+
 @view('blogs.html')
 @get('/')
+@query_budget(3)
 def index():
-	blogs, page = _get_blogs_by_page()
-	return dict(page=page, blogs=blogs, user=ctx.request.user)
+	blogs, page = _get_blogs_by_page(('name', 'summary', 'created_at', 'comment_count', 'last_commented_at'))
+	return dict(page=page, blogs=blogs, hot_blogs=pageviews.hot_blogs(_HOT_BLOGS), user=ctx.request.user)
+
+
+def _merge_pending_comments(blog_id, comments):
+	# comments queued by write-behind are shown before they are written:
+	pending = Comment.pending(blog_id=blog_id)
+	if not pending:
+		return comments
+	ids = set(c.id for c in comments)
+	L = [c for c in pending if not c.id in ids] + comments
+	L.sort(key=lambda c: c.created_at, reverse=True)
+	return L
+
 
+# comments rendered with the blog page and returned by each api call:
+_COMMENTS_PAGE_SIZE = 20
 
-@view('blog.html')
+def _comment_cursor(c):
+	'''
+	Return cursor of the comment, the next page starts after it.
+	'''
+	return '%r-%s' % (c.created_at, c.id)
+
+
+def _parse_comment_cursor(after):
+	try:
+		created_at, id = after.rsplit('-', 1)
+		return float(created_at), id
+	except ValueError:
+		raise APIValueError('after', 'Invalid cursor.')
+
+
+def _get_comments_by_cursor(blog_id, after=None, limit=_COMMENTS_PAGE_SIZE):
+	'''
+	Return comments of blog newer first, and cursor of next page or None.
+	'''
+	# comments are ordered by (created_at, id) which is index (blog_id, created_at)
+	# plus the primary key, so any page is read from the index without offset.
+	# one more comment is fetched to tell if there is a next page:
+	if after:
+		created_at, id = _parse_comment_cursor(after)
+		comments = Comment.find_by('where blog_id=? and (created_at<? or (created_at=? and id<?)) order by created_at desc, id desc limit ?', blog_id, created_at, created_at, id, limit + 1)
+	else:
+		comments = Comment.find_by('where blog_id=? order by created_at desc, id desc limit ?', blog_id, limit + 1)
+	if len(comments) > limit:
+		comments = comments[:limit]
+		return comments, _comment_cursor(comments[-1])
+	return comments, None
+
+
+@view('blog.html', stream=True)
 @get('/blog/:blog_id')
+@query_budget(3)
 def blog(blog_id):
-	blog = Blog.get(blog_id)
+	# only the first page of comments is rendered, the others are loaded by api:
+	blog, (comments, next_cursor), views = db.gather(lambda: Blog.get(blog_id), lambda: _get_comments_by_cursor(blog_id), lambda: pageviews.views(blog_id))
 	if blog is None:
 		raise notfound()
+	pageviews.record(blog_id)
+	blog.views = views + 1
+	comments = _merge_pending_comments(blog_id, comments)
 	blog.html_content = markdown2.markdown(blog.content) # change content to html form
-	comments = Comment.find_by('where blog_id=? order by created_at desc limit 1000', blog_id)
-	return dict(blog=blog, comments=comments, user=ctx.request.user)
+	return dict(blog=blog, comments=comments, next_cursor=next_cursor, push=pubsub.cooperative(), user=ctx.request.user)
 
 
 @view('signin.html')
@@ -131,7 +229,6 @@ def authenticate():
 	max_age = 604800 if remember == 'true' else None
 	cookie = make_signed_cookie(user.id, user.password, max_age)
 	ctx.response.set_cookie(_COOKIE_NAME, cookie, max_age=max_age)
-	user.password = '******'
 	return user
 
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
@@ -167,10 +264,18 @@ def register():
 	return dict()
 
 
-def _get_blogs_by_page():
-	total = Blog.count_all()
-	page = Page(total, _get_page_index())
-	blogs = Blog.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
+# blog lists are cached for a while, and invalidated at once by writes to blogs:
+_BLOGS_CACHE_TTL = 60
+
+def _get_blogs_by_page(fields=None):
+	# count and fetch concurrently, assuming the requested page exists:
+	page_index = _get_page_index()
+	offset = Page.PAGE_SIZE * (max(page_index, 1) - 1)
+	total, blogs = db.gather(lambda: Blog.count_all(cache=_BLOGS_CACHE_TTL), lambda: Blog.find_by('order by created_at desc limit ?,?', offset, Page.PAGE_SIZE, fields=fields, cache=_BLOGS_CACHE_TTL))
+	page = Page(total, page_index)
+	if page.limit == 0:
+		# out of range, the same as 'limit 0,0':
+		blogs = []
 	return blogs, page
 
 
@@ -233,10 +338,11 @@ def manage_users():
 @get('/api/blogs')
 def api_get_blogs():
 	format = ctx.request.get('format', '')
-	blogs, page = _get_blogs_by_page()
+	blogs, page = _get_blogs_by_page(_get_fields(Blog))
 	if format=='html':
 		for blog in blogs:
-			blog.content = markdown2.markdown(blog.content)
+			if 'content' in blog:
+				blog.content = markdown2.markdown(blog.content)
 	return dict(blogs=blogs, page=page)
 
 
@@ -317,10 +423,59 @@ def api_create_blog_comment(blog_id):
 	if not content:
 		raise APIValueError('content')
 	c = Comment(blog_id=blog_id, user_id=user.id, user_name=user.name, user_image=user.image, content=content)
-	c.insert()
+	c.insert(deferred=True)
 	return dict(comment=c)
 
 
+_COMMENTS_MAX_PAGE_SIZE = 100
+
+@api
+@get('/api/blogs/:blog_id/comments')
+def api_get_blog_comments(blog_id):
+	try:
+		limit = min(int(ctx.request.get('limit', str(_COMMENTS_PAGE_SIZE))), _COMMENTS_MAX_PAGE_SIZE)
+	except ValueError:
+		raise APIValueError('limit')
+	if limit <= 0:
+		raise APIValueError('limit')
+	after = ctx.request.get('after', '')
+	if not after and Blog.get(blog_id) is None:
+		raise APIResourceNotFoundError('Blog')
+	comments, next_cursor = _get_comments_by_cursor(blog_id, after, limit)
+	if not after:
+		comments = _merge_pending_comments(blog_id, comments)
+	return dict(comments=comments, next=next_cursor)
+
+
+# comments sent again to a reconnected client, older ones are loaded by the api above:
+_COMMENTS_REPLAY_MAX = 100
+
+@get('/api/blogs/:blog_id/comments/events')
+def api_blog_comment_events(blog_id):
+	'''
+	Server-Sent Events of new comments of blog. The client passes the created_at
+	of the newest comment it has by ?since=, or by Last-Event-ID when reconnecting.
+	'''
+	if not pubsub.cooperative():
+		# each connection would take the only thread of the local server:
+		raise HttpError(503)
+	since = ctx.request.header('Last-Event-ID') or ctx.request.get('since', '')
+	try:
+		since = float(since) if since else None
+	except ValueError:
+		raise badrequest()
+	def _missed():
+		if since is None:
+			return []
+		comments = Comment.find_by('where blog_id=? and created_at>? order by created_at limit ?', blog_id, since, _COMMENTS_REPLAY_MAX)
+		return [pubsub.sse_event(json.dumps(c), event='comment', id=repr(c.created_at)) for c in comments]
+	ctx.response.content_type = 'text/event-stream'
+	ctx.response.set_header('Cache-Control', 'no-cache')
+	# let nginx send each event at once:
+	ctx.response.set_header('X-Accel-Buffering', 'no')
+	return pubsub.hub.stream('blog:%s' % blog_id, configs.push.heartbeat, _missed)
+
+
 @api
 @post('/api/comments/:comment_id/delete')
 def api_delete_comment(comment_id):
@@ -337,7 +492,9 @@ def api_delete_comment(comment_id):
 def api_get_comments():
 	total = Comment.count_all()
 	page = Page(total, _get_page_index())
-	comments = Comment.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
+	comments = Comment.find_by('order by created_at desc limit ?,?', page.offset, page.limit, fields=_get_fields(Comment))
+	# attach the blog of each comment with one query:
+	prefetch(comments, 'blog_id', Blog, fields=['name'])
 	return dict(comments=comments, page=page)
 
 
@@ -346,16 +503,125 @@ def api_get_comments():
 def api_get_users():
 	total = User.count_all()
 	page = Page(total, _get_page_index())
-	users = User.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
-	for u in users:
-		# replace password with '******'
-		u.password = '******'
+	users = User.find_by('order by created_at desc limit ?,?', page.offset, page.limit, fields=_get_fields(User))
 	return dict(users=users, page=page)
 
 
+@get('/metrics')
+def get_metrics():
+	'''
+	Request metrics of this process in Prometheus text format, only reachable
+	from localhost through nginx.
+	'''
+	ctx.response.content_type = 'text/plain; version=0.0.4'
+	return metrics.render()
+
+
+@view('manage_db_stats.html')
+@get('/manage/db-stats')
+def manage_db_stats():
+	return dict(stats=profiler.snapshot(), slow_queries=profiler.slow_queries(), user=ctx.request.user)
+
+
+@api
+@get('/api/db-stats')
+def api_get_db_stats():
+	check_admin()
+	return profiler.snapshot()
+
+
+@api
+@get('/api/slow-queries')
+def api_get_slow_queries():
+	check_admin()
+	return profiler.slow_queries()
+
+
+@api
+@get('/api/cache-stats')
+def api_get_cache_stats():
+	check_admin()
+	return dict(models=cache_stats(), queries=db.query_cache.stats())
+
+
+_SEARCH_MAX_RESULTS = 50
+
+@api
+@get('/api/search')
+def api_search():
+	q = ctx.request.get('q', '').strip()
+	if not q:
+		raise APIValueError('q', 'q cannot be empty.')
+	try:
+		limit = min(int(ctx.request.get('limit', '20')), _SEARCH_MAX_RESULTS)
+	except ValueError:
+		raise APIValueError('limit')
+	return dict(results=search.search(q, limit))
+
+
+_HOT_BLOGS_MAX = 50
+
+@api
+@get('/api/hot-blogs')
+def api_hot_blogs():
+	try:
+		limit = min(int(ctx.request.get('limit', '10')), _HOT_BLOGS_MAX)
+	except ValueError:
+		raise APIValueError('limit')
+	return dict(blogs=pageviews.hot_blogs(limit))
+
+
+
+_BATCH_MAX_REQUESTS = 20
+
+def _parse_batch_requests():
+	try:
+		L = json.loads(ctx.request.get('requests', '[]'))
+	except ValueError:
+		raise APIValueError('requests', 'Invalid JSON.')
+	if not isinstance(L, list) or len(L) > _BATCH_MAX_REQUESTS:
+		raise APIValueError('requests', 'Expect a list of at most %d requests.' % _BATCH_MAX_REQUESTS)
+	requests = []
+	for r in L:
+		if not isinstance(r, dict):
+			raise APIValueError('requests', 'Invalid request: %s' % r)
+		method = r.get('method', 'GET').upper()
+		path = r.get('path', '')
+		params = r.get('params') or {}
+		if not method in ('GET', 'POST') or not path.startswith('/api/') or path.startswith('/api/batch') or not isinstance(params, dict):
+			raise APIValueError('requests', 'Invalid request: %s %s' % (method, path))
+		requests.append((method, subrequest(method, path, params)))
+	return requests
+
+
+@api
+@post('/api/batch')
+def api_batch():
+	'''
+	Dispatch several API calls in one HTTP request with the current session.
+	The 'requests' parameter is a JSON list like:
+		[{"method": "GET", "path": "/api/blogs", "params": {"page": 2}}, ...]
+	Consecutive GETs run concurrently, POSTs run one by one in order. Streamed
+	responses like the comment events get status 400.
+	'''
+	requests = _parse_batch_requests()
+	results = []
+	i = 0
+	while i < len(requests):
+		j = i
+		while j < len(requests) and requests[j][0]=='GET':
+			j = j + 1
+		if j > i:
+			results.extend(db.gather(*[fn for method, fn in requests[i:j]]))
+			i = j
+		else:
+			results.append(requests[i][1]())
+			i = i + 1
+	return [dict(status=int(status[:3]), body=json.loads(body) if content_type=='application/json' else None) for status, content_type, body in results]
+
 
 @view('test_users.html')
 @get('/test_users')
 def test_users():
 	users = User.find_all()
-	return dict(users=users)
\ No newline at end of file
+	return dict(users=users)
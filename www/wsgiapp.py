@@ -7,11 +7,18 @@ __author__ = 'Jack Bai'
 A WSGI application entry.
 '''
 
+import sys
+
+# 使用gevent启动本地服务器时，需要在导入其他模块前打补丁:
+_SERVER = 'gevent' if __name__=='__main__' and '--gevent' in sys.argv else 'wsgiref'
+if _SERVER=='gevent':
+	from gevent import monkey; monkey.patch_all()
+
 import logging; logging.basicConfig(level=logging.INFO)
 import os, time
 from datetime import datetime
 
-from transwarp import db
+from transwarp import db, orm, cache, profiler, writebehind, pubsub, metrics
 from transwarp.web import WSGIApplication, Jinja2TemplateEngine
 
 from config import configs
@@ -34,24 +41,62 @@ def datetime_filter(t):
 # init db(初始化数据库):
 db.create_engine(**configs.db)
 
+# 查询结果缓存的内存上限:
+db.query_cache.max_bytes = configs.cache.query_max_bytes
+
+# SQL性能统计:
+profiler.enabled = configs.profiler.enabled
+profiler.slow_seconds = configs.profiler.slow_seconds
+profiler.detect_threshold = configs.profiler.detect_threshold
+profiler.strict = configs.profiler.strict
+db.explain_format = configs.profiler.explain_format
+
+# 请求统计，由/metrics导出:
+metrics.enabled = configs.metrics.enabled
+
+# 模型缓存默认在进程内，配置memcached后由多个进程共享:
+if configs.cache.model_backend:
+	orm.set_cache_backend(cache.create_backend(configs.cache.model_backend))
+
+# 评论先写入队列，由后台线程批量写入数据库:
+if configs.write_behind.comments:
+	from models import Comment
+	wb = configs.write_behind
+	comment_queue = writebehind.WriteBehindQueue(Comment.__table__, batch_size=wb.batch_size, interval=wb.interval, max_pending=wb.max_pending, timeout=wb.timeout)
+	orm.set_write_behind(Comment, comment_queue)
+	metrics.gauge('write_behind_pending_rows', 'Comments not written yet.', lambda: len(comment_queue.pending()))
+
+# 新评论推送给正在阅读的客户端，每个客户端最多缓存的事件数:
+pubsub.hub.max_buffer = configs.push.max_buffer
+metrics.gauge('push_subscribers', 'Open event streams.', pubsub.hub.subscribers)
+
 # init wsgi app(创建一个WSGIApplication):
 wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
 
+# 模板片段缓存默认在进程内，配置目录后在同一主机的多个进程间共享:
+if configs.template.fragment_cache_dir:
+	cache.fragments.backend = cache.FileCache(configs.template.fragment_cache_dir)
+
 # 初始化jinja2模板引擎:
-template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'), cache_dir=configs.template.cache_dir, auto_reload=configs.template.auto_reload)
 template_engine.add_filter('datetime', datetime_filter)
+# 启动时预编译全部模板:
+template_engine.precompile()
 
 wsgi.template_engine = template_engine
 
 # 加载带有@get/@post的URL处理函数:
 import urls
 
+wsgi.add_interceptor(urls.profiler_interceptor)
+wsgi.add_interceptor(urls.identity_map_interceptor)
+wsgi.add_interceptor(urls.read_your_writes_interceptor)
 wsgi.add_interceptor(urls.user_interceptor)
 wsgi.add_interceptor(urls.manage_interceptor)
 wsgi.add_module(urls)
 
 # 在9000端口上启动本地测试服务器:
 if __name__ == '__main__':
-	wsgi.run(9000, host='0.0.0.0')
+	wsgi.run(9000, host='0.0.0.0', server=_SERVER)
 else:
 	application = wsgi.get_wsgi_application()
\ No newline at end of file